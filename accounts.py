@@ -0,0 +1,46 @@
+from typing import Optional, List
+
+from pyrogram import Client
+from loguru import logger
+
+import uploads as uploads
+from ratelimit import Scheduler
+
+
+class Account:
+    # a bot and everything that is tied to it: its rate limits and the parts it uploaded can't be used by other bots
+    def __init__(self, client: Client, scheduler: Scheduler, resumable_uploader: Optional[uploads.ResumableUploader] = None):
+        self.client = client
+        self.scheduler = scheduler
+        self.resumable_uploader = resumable_uploader
+
+    @property
+    def name(self) -> str:
+        return self.client.name
+
+
+class AccountPool:
+    # spreads the directories across the bots: every directory is uploaded and posted by a single bot, picked in turns.
+    # Bots that have to wait for a flood wait longer than `max_flood_wait` seconds are skipped, so new directories go to
+    # the others. The posting order doesn't depend on which bot posts a message, see utilities.PostingOrder
+    def __init__(self, accounts: List[Account], max_flood_wait=60):
+        self.accounts = accounts
+        self._max_flood_wait = max_flood_wait
+        self._next_index = 0
+
+    @property
+    def main(self) -> Account:
+        return self.accounts[0]
+
+    def pick(self) -> Account:
+        candidates = self.accounts[self._next_index:] + self.accounts[:self._next_index]
+        account = next((a for a in candidates if a.scheduler.flood_wait_remaining <= self._max_flood_wait), None)
+        if not account:
+            # everyone is waiting: pick who will be available first
+            account = min(candidates, key=lambda a: a.scheduler.flood_wait_remaining)
+
+        if account is not candidates[0]:
+            logger.info(f"skipping flood-waited bots, next directory goes to {account.name}")
+
+        self._next_index = (self.accounts.index(account) + 1) % len(self.accounts)
+        return account
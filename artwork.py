@@ -0,0 +1,109 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+from loguru import logger
+
+import metadata as metadata
+
+
+class FileName:
+    THUMBNAILS_DIR = "data/thumbnails"
+
+
+# https://core.telegram.org/api/files#uploading-thumbnails: jpeg, max 320px per side, max 200 kb
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+JPEG_QUALITIES = (90, 80, 70, 60, 50, 40)
+
+
+def prepare_thumbnail(image_data: bytes) -> Optional[bytes]:
+    # downsize and re-encode an artwork so it fits Telegram's thumbnail limits. Returns None if the image can't be decoded
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        image.thumbnail((THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE))
+        image = image.convert("RGB")
+    except Exception as e:
+        logger.warning(f"unable to decode artwork: {e}")
+        return
+
+    for quality in JPEG_QUALITIES:
+        thumb = io.BytesIO()
+        image.save(thumb, "JPEG", quality=quality, optimize=True)
+        if thumb.tell() <= THUMBNAIL_MAX_BYTES:
+            break
+
+    return thumb.getvalue()
+
+
+class ThumbnailCache:
+    # thumbnails are prepared once per artwork (keyed by its content hash) and stored in THUMBNAILS_DIR. The most
+    # recently used ones are also kept in memory: tracks of the same album are usually uploaded one after the other.
+    # When the directory grows past `max_size` bytes, the least recently used files are deleted
+    def __init__(self, max_size: int, memory_items=64, dir_path=FileName.THUMBNAILS_DIR):
+        self._dir_path = dir_path
+        self._max_size = max_size
+        self._memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()  # get() is called from the executor's threads
+
+        os.makedirs(self._dir_path, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(self._dir_path) if entry.is_file())
+
+    def _remember(self, artwork_hash: str, thumb: bytes):
+        self._memory[artwork_hash] = thumb
+        self._memory.move_to_end(artwork_hash)
+        while len(self._memory) > self._memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        if self._size <= self._max_size:
+            return
+
+        entries = sorted((entry for entry in os.scandir(self._dir_path) if entry.is_file()), key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            # leave some room, so we don't scan the directory again on the next thumbnail
+            if self._size <= self._max_size * 0.9:
+                break
+
+            self._size -= entry.stat().st_size
+            os.remove(entry.path)
+            self._memory.pop(entry.name.replace(".jpg", ""), None)
+
+    def get(self, artwork_hash: str) -> Optional[bytes]:
+        # None: the artwork is missing or it can't be decoded
+        with self._lock:
+            if artwork_hash in self._memory:
+                self._memory.move_to_end(artwork_hash)
+                return self._memory[artwork_hash] or None
+
+            file_path = os.path.join(self._dir_path, f"{artwork_hash}.jpg")
+            try:
+                with open(file_path, "rb") as f:
+                    thumb = f.read()
+                os.utime(file_path)  # the mtime is used to evict the least recently used thumbnails
+                self._remember(artwork_hash, thumb)
+                return thumb
+            except FileNotFoundError:
+                pass
+
+            image_data = metadata.read_artwork(artwork_hash)
+            if not image_data:
+                return
+
+            thumb = prepare_thumbnail(image_data)
+            if not thumb:
+                # don't try to decode it again for every track of the album
+                self._remember(artwork_hash, b"")
+                return
+
+            with open(file_path, "wb") as f:
+                f.write(thumb)
+            self._size += len(thumb)
+            self._remember(artwork_hash, thumb)
+            self._evict()
+
+            return thumb
@@ -0,0 +1,157 @@
+import mmap
+import os
+import struct
+from typing import Optional, Union, NamedTuple
+from pathlib import Path
+
+import tagreaders as tagreaders
+
+
+# https://www.mp3-tech.org/programmer/frame_header.html
+# bitrates in kbps, indexed by [version is mpeg 1][layer][bitrate index]
+BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+# indexed by the version bits: 0 = mpeg 2.5, 2 = mpeg 2, 3 = mpeg 1
+SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+LAYERS = {1: 3, 2: 2, 3: 1}  # layer bits -> layer
+
+MAX_SYNC_SEARCH = 64 * 1024  # bytes after the id3v2 tag where the first frame is looked for
+ID3V1_SIZE = 128
+
+
+class FrameHeader(NamedTuple):
+    offset: int
+    mpeg1: bool
+    layer: int
+    bitrate: int  # bps
+    sample_rate: int
+    mono: bool
+
+    @property
+    def samples_per_frame(self) -> int:
+        if self.layer == 1:
+            return 384
+        if self.layer == 2 or self.mpeg1:
+            return 1152
+
+        return 576
+
+    @property
+    def side_info_size(self) -> int:
+        # the xing header comes right after the side information of the first frame
+        if self.mpeg1:
+            return 17 if self.mono else 32
+
+        return 9 if self.mono else 17
+
+
+def id3v2_size(data: Union[mmap.mmap, bytes]) -> int:
+    # size of the id3v2 tag at the beginning of the file, header (and footer) included
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+
+    # syncsafe integer: 7 bits per byte
+    size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f)
+    footer = 10 if data[5] & 0x10 else 0
+
+    return 10 + size + footer
+
+
+def parse_frame_header(data: Union[mmap.mmap, bytes], offset: int) -> Optional[FrameHeader]:
+    if offset + 4 > len(data) or data[offset] != 0xff or data[offset + 1] & 0xe0 != 0xe0:
+        return
+
+    version_bits = (data[offset + 1] >> 3) & 0x03
+    layer_bits = (data[offset + 1] >> 1) & 0x03
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0x03
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        # reserved values (or free bitrate): not a frame header
+        return
+
+    mpeg1 = version_bits == 3
+    layer = LAYERS[layer_bits]
+    return FrameHeader(
+        offset=offset,
+        mpeg1=mpeg1,
+        layer=layer,
+        bitrate=BITRATES[mpeg1][layer][bitrate_index] * 1000,
+        sample_rate=SAMPLE_RATES[version_bits][sample_rate_index],
+        mono=data[offset + 3] >> 6 == 3
+    )
+
+
+def find_first_frame(data: Union[mmap.mmap, bytes], start: int) -> Optional[FrameHeader]:
+    offset = data.find(b"\xff", start, start + MAX_SYNC_SEARCH)
+    while offset != -1:
+        header = parse_frame_header(data, offset)
+        if header:
+            return header
+
+        offset = data.find(b"\xff", offset + 1, start + MAX_SYNC_SEARCH)
+
+
+def vbr_frames_count(data: Union[mmap.mmap, bytes], header: FrameHeader) -> Optional[int]:
+    # number of frames stored by the encoder in the xing/info (lame) or vbri header of the first frame
+    xing_offset = header.offset + 4 + header.side_info_size
+    if data[xing_offset:xing_offset + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing_offset + 4:xing_offset + 8])[0]
+        if flags & 0x1:
+            return struct.unpack(">I", data[xing_offset + 8:xing_offset + 12])[0]
+
+        return
+
+    vbri_offset = header.offset + 4 + 32
+    if data[vbri_offset:vbri_offset + 4] == b"VBRI":
+        return struct.unpack(">I", data[vbri_offset + 14:vbri_offset + 18])[0]
+
+
+def mp3_data_duration(data: Union[mmap.mmap, bytes]) -> Optional[float]:
+    # duration in seconds read from the first frame only: the frames count of the vbr header if there's one, otherwise
+    # the file is considered cbr and the duration is estimated from the audio size and the bitrate
+    file_size = len(data)
+    header = find_first_frame(data, id3v2_size(data))
+    if not header:
+        return
+
+    frames_count = vbr_frames_count(data, header)
+    if frames_count:
+        return frames_count * header.samples_per_frame / header.sample_rate
+
+    audio_size = file_size - header.offset
+    if file_size >= ID3V1_SIZE and data[file_size - ID3V1_SIZE:file_size - ID3V1_SIZE + 3] == b"TAG":
+        audio_size -= ID3V1_SIZE
+
+    return audio_size * 8 / header.bitrate
+
+
+def mp3_duration(file_path: Union[Path, str]) -> Optional[float]:
+    # the file is memory-mapped, so only the pages that are actually read are loaded from the disk
+    with open(file_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return mp3_data_duration(data)
+
+
+def duration(file_path: Union[Path, str]) -> Optional[float]:
+    # runs in the scan processes: do not log from here. None: unsupported format or no valid header
+    try:
+        if str(file_path).lower().endswith(".mp3"):
+            return mp3_duration(file_path)
+
+        tags = tagreaders.read(file_path, images=False)
+        return tags["time_secs"] if tags else None
+    except (OSError, ValueError, IndexError, struct.error):
+        return
@@ -0,0 +1,60 @@
+from typing import Callable, Union
+
+from pyrogram import Client, types
+from loguru import logger
+
+
+class CrawlState:
+    # where the crawl of a chat's history stopped: "newest_id" (every message up to it is indexed), "oldest_id" (oldest
+    # message indexed while going backwards), "complete" (the start of the chat has been reached) and "pending_newest_id"
+    # (newest message seen by a pass over the new messages that didn't reach "newest_id" yet). commit() checkpoints
+    # them, together with whatever the crawl indexed so far. Missing keys are 0
+    def get_state(self, key: str) -> int:
+        raise NotImplementedError
+
+    def set_state(self, key: str, value: int):
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+
+async def index_messages(messages, state: CrawlState, on_message: Callable[[types.Message], None], stop_at_id=0, newest_key="newest_id") -> int:
+    count = 0
+    async for message in messages:
+        if message.id <= stop_at_id:
+            break
+
+        state.set_state(newest_key, max(state.get_state(newest_key), message.id))
+        state.set_state("oldest_id", min(state.get_state("oldest_id") or message.id, message.id))
+        on_message(message)
+
+        count += 1
+        if count % 100 == 0:
+            # one page of history: checkpoint
+            state.commit()
+            logger.info(f"indexed {count} messages (oldest: {state.get_state('oldest_id')})")
+
+    state.commit()
+    return count
+
+
+async def crawl(client: Client, chat_id: Union[int, str], state: CrawlState, on_message: Callable[[types.Message], None]):
+    # history is returned newest first: first index what was posted after the newest indexed message, then keep going
+    # backwards from where the previous crawl stopped
+    if state.get_state("newest_id"):
+        # the messages between the old top and where this pass is interrupted would be skipped by the next run if the
+        # new top was saved as "newest_id" right away: it's saved once the pass gets down to the old top
+        count = await index_messages(
+            client.get_chat_history(chat_id), state, on_message, stop_at_id=state.get_state("newest_id"), newest_key="pending_newest_id"
+        )
+        state.set_state("newest_id", max(state.get_state("newest_id"), state.get_state("pending_newest_id")))
+        state.set_state("pending_newest_id", 0)
+        state.commit()
+        logger.info(f"indexed {count} new messages")
+
+    if not state.get_state("complete"):
+        count = await index_messages(client.get_chat_history(chat_id, offset_id=state.get_state("oldest_id")), state, on_message)
+        state.set_state("complete", 1)
+        state.commit()
+        logger.info(f"crawl completed, {count} older messages indexed")
@@ -0,0 +1,344 @@
+import mmap
+import os
+import struct
+import contextlib
+from pathlib import Path
+from typing import Optional, Union, List, Dict, Tuple, NamedTuple, Callable
+
+import eyed3.id3
+
+import audioinfo as audioinfo
+
+
+# lightweight id3 reader for the scan: the file is memory-mapped and only the frame headers are parsed. Text frames are
+# decoded when they are asked for, pictures are returned as memoryviews over the mapped file, so the artworks that are
+# not needed are never read from the disk. https://id3.org/id3v2.4.0-structure, https://id3.org/id3v2.3.0
+
+
+class UnsupportedTag(Exception):
+    # the caller falls back to eyed3
+    pass
+
+
+# id3v2.2 frame ids of the frames we read
+V22_FRAME_IDS = {
+    b"TT2": b"TIT2",
+    b"TP1": b"TPE1",
+    b"TP2": b"TPE2",
+    b"TAL": b"TALB",
+    b"TCO": b"TCON",
+    b"TCM": b"TCOM",
+    b"TYE": b"TYER",
+    b"TDA": b"TDAT",
+    b"TOR": b"TORY",
+    b"TPA": b"TPOS",
+    b"TXX": b"TXXX",
+    b"PIC": b"APIC",
+}
+TEXT_ENCODINGS = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}
+
+# v2.3 frame flags
+V23_COMPRESSED = 0x0080
+V23_ENCRYPTED = 0x0040
+V23_GROUPED = 0x0020
+# v2.4 frame flags
+V24_GROUPED = 0x0040
+V24_COMPRESSED = 0x0008
+V24_ENCRYPTED = 0x0004
+V24_UNSYNCHRONISED = 0x0002
+V24_DATA_LENGTH = 0x0001
+
+ALBUM_TYPE_DESCRIPTION = "eyeD3#album_type"  # the TXXX frame eyed3 uses
+
+
+class FrameRef(NamedTuple):
+    offset: int  # of the frame data, in the tag body
+    size: int
+    unsynchronised: bool
+
+
+def syncsafe(data) -> int:
+    return (data[0] & 0x7f) << 21 | (data[1] & 0x7f) << 14 | (data[2] & 0x7f) << 7 | (data[3] & 0x7f)
+
+
+def resync(data) -> bytes:
+    return bytes(data).replace(b"\xff\x00", b"\xff")
+
+
+def split_terminated(data, encoding: int) -> Tuple[bytes, int]:
+    # (value, offset after the terminator) of a string terminated by a null character in the given encoding
+    if encoding in (1, 2):
+        offset = 0
+        while True:
+            offset = bytes(data).find(b"\x00\x00", offset)
+            if offset == -1:
+                return bytes(data), len(data)
+            if offset % 2 == 0:
+                return bytes(data[:offset]), offset + 2
+            offset += 1
+
+    offset = bytes(data).find(b"\x00")
+    if offset == -1:
+        return bytes(data), len(data)
+
+    return bytes(data[:offset]), offset + 1
+
+
+def decode(data: bytes, encoding: int) -> str:
+    if encoding not in TEXT_ENCODINGS:
+        raise UnsupportedTag(f"text encoding {encoding}")
+
+    return data.decode(TEXT_ENCODINGS[encoding])
+
+
+class ID3v2Tag:
+    def __init__(self, body: memoryview, version: int):
+        self._body = body
+        self.version = version
+        self._frames: Dict[bytes, List[FrameRef]] = {}
+
+    @classmethod
+    def parse(cls, data: Union[mmap.mmap, bytes]) -> Optional["ID3v2Tag"]:
+        if len(data) < 10 or data[:3] != b"ID3":
+            return
+
+        version, flags = data[3], data[5]
+        if version not in (2, 3, 4):
+            raise UnsupportedTag(f"id3v2.{version}")
+
+        body = memoryview(data)[10:10 + syncsafe(data[6:10])]
+        if flags & 0x80 and version < 4:
+            # unsynchronisation of the whole tag: frame headers included
+            body = memoryview(resync(body))
+
+        offset = 0
+        if flags & 0x40:
+            if version == 2:
+                # compression, never specified
+                raise UnsupportedTag("compressed id3v2.2 tag")
+            offset = struct.unpack(">I", body[:4])[0] + 4 if version == 3 else syncsafe(body[:4])
+
+        tag = cls(body, version)
+        tag._index_frames(offset)
+        return tag
+
+    def _index_frames(self, offset: int):
+        header_size = 6 if self.version == 2 else 10
+        body = self._body
+        while offset + header_size <= len(body):
+            if self.version == 2:
+                frame_id = V22_FRAME_IDS.get(bytes(body[offset:offset + 3]), bytes(body[offset:offset + 3]))
+                size = int.from_bytes(body[offset + 3:offset + 6], "big")
+                frame_flags = 0
+            else:
+                frame_id = bytes(body[offset:offset + 4])
+                size = syncsafe(body[offset + 4:offset + 8]) if self.version == 4 else struct.unpack(">I", body[offset + 4:offset + 8])[0]
+                frame_flags = struct.unpack(">H", body[offset + 8:offset + 10])[0]
+
+            if not frame_id.isalnum() or frame_id != frame_id.upper():
+                # padding
+                return
+
+            data_offset = offset + header_size
+            offset = data_offset + size
+            if offset > len(body):
+                return
+
+            if self.version == 3:
+                if frame_flags & (V23_COMPRESSED | V23_ENCRYPTED):
+                    continue
+                if frame_flags & V23_GROUPED:
+                    data_offset += 1
+            elif self.version == 4:
+                if frame_flags & (V24_COMPRESSED | V24_ENCRYPTED):
+                    continue
+                if frame_flags & V24_GROUPED:
+                    data_offset += 1
+                if frame_flags & V24_DATA_LENGTH:
+                    data_offset += 4
+
+            self._frames.setdefault(frame_id, []).append(FrameRef(data_offset, offset - data_offset, bool(frame_flags & V24_UNSYNCHRONISED)))
+
+    def _frame_data(self, frame: FrameRef) -> Union[memoryview, bytes]:
+        data = self._body[frame.offset:frame.offset + frame.size]
+        return resync(data) if frame.unsynchronised else data
+
+    def text(self, frame_id: bytes) -> Optional[str]:
+        # first value of a text frame
+        for frame in self._frames.get(frame_id, []):
+            data = bytes(self._frame_data(frame))
+            if not data:
+                continue
+
+            value = decode(data[1:], data[0]).split("\x00")[0]
+            if value:
+                return value
+
+    def user_text(self, description: str) -> Optional[str]:
+        for frame in self._frames.get(b"TXXX", []):
+            data = bytes(self._frame_data(frame))
+            if not data:
+                continue
+
+            frame_description, value_offset = split_terminated(data[1:], data[0])
+            if decode(frame_description, data[0]) == description:
+                return decode(data[1 + value_offset:], data[0]).split("\x00")[0] or None
+
+    @property
+    def pictures_count(self) -> int:
+        return len(self._frames.get(b"APIC", []))
+
+    def picture(self, index: int) -> memoryview:
+        # image data of the index-th picture frame, in file order as eyed3 returns them. A slice of the mapped file:
+        # nothing is read until it's used, and it must be released before the file is closed
+        return self._picture(index)[1]
+
+    def picture_type(self, index: int) -> int:
+        # eyed3.id3.frames.ImageFrame constants (3: front cover)
+        return self._picture(index)[0]
+
+    def _picture(self, index: int) -> Tuple[int, memoryview]:
+        data = memoryview(self._frame_data(self._frames[b"APIC"][index]))
+        encoding = data[0]
+        if self.version == 2:
+            offset = 4  # encoding, 3 bytes image format
+        else:
+            _, mime_length = split_terminated(data[1:], 0)
+            offset = 1 + mime_length
+
+        picture_type = data[offset]
+        offset += 1
+        _, description_length = split_terminated(data[offset:], encoding)
+
+        return picture_type, data[offset + description_length:]
+
+    # dates are read from the same frames eyed3 uses for each version: v2.3 (and v2.2) have no TDRC/TDRL/TDOR
+
+    def original_release_date(self) -> Optional[str]:
+        date = self.text(b"TDOR") if self.version == 4 else None
+        return date or self.text(b"XDOR") or self.text(b"TORY")
+
+    def release_date(self) -> Optional[str]:
+        return self.text(b"TDRL") if self.version == 4 else self.original_release_date()
+
+    def recording_date(self) -> Optional[str]:
+        if self.version == 4:
+            return self.text(b"TDRC")
+
+        year = self.text(b"TYER")
+        day_month = self.text(b"TDAT")
+        if year and day_month and len(day_month) == 4:
+            return f"{year}-{day_month[2:]}-{day_month[:2]}"
+
+        return year
+
+
+def parse_disc_num(value: Optional[str]) -> List[Optional[int]]:
+    # "1/2" -> [1, 2]
+    parts = (value or "").split("/")
+    return [int(p) if p.strip().isdigit() else None for p in (parts + [""])[:2]]
+
+
+def genre_name(value: Optional[str]) -> Optional[str]:
+    # "(17)", "17" or "Rock": same parsing as eyed3
+    if not value:
+        return
+
+    genre = eyed3.id3.Genre.parse(value)
+    return genre.name if genre else None
+
+
+def read_id3v1(data: Union[mmap.mmap, bytes]) -> Optional[dict]:
+    if len(data) < audioinfo.ID3V1_SIZE or data[-audioinfo.ID3V1_SIZE:-audioinfo.ID3V1_SIZE + 3] != b"TAG":
+        return
+
+    tag = data[-audioinfo.ID3V1_SIZE:]
+
+    def field(start: int, end: int) -> Optional[str]:
+        return bytes(tag[start:end]).split(b"\x00")[0].decode("latin-1").strip() or None
+
+    # a year like eyed3 reads it: the release date, if it's a number other than 0
+    year = field(93, 97)
+    try:
+        year = str(int(year)) if year and int(year) else None
+    except ValueError:
+        year = None
+
+    genre = eyed3.id3.genres.get(tag[127])
+    return dict(
+        title=field(3, 33),
+        artist=field(33, 63),
+        album=field(63, 93),
+        album_artist=None,
+        album_type=None,
+        genre=genre.name if genre else None,
+        composer=None,
+        disc_num=[None, None],
+        release_date=year,
+        original_release_date=None,
+        recording_date=None,
+        artworks=[]
+    )
+
+
+def read_mapped(data: mmap.mmap, save_artwork: Callable, max_artworks: Optional[int]) -> Optional[dict]:
+    time_secs = audioinfo.mp3_data_duration(data)
+    tag = ID3v2Tag.parse(data)
+    if time_secs is None and not tag:
+        return
+
+    # eyed3 only sets these when it finds an mpeg frame
+    metadata = dict(time_secs=time_secs, size_bytes=len(data)) if time_secs is not None else dict()
+    if not tag:
+        # "artworks" is only set when there's a tag, like eyed3 does
+        metadata.update(read_id3v1(data) or {})
+        return metadata
+
+    metadata["title"] = tag.text(b"TIT2")
+    metadata["artist"] = tag.text(b"TPE1")
+    metadata["album"] = tag.text(b"TALB")
+    metadata["album_artist"] = tag.text(b"TPE2")
+    metadata["album_type"] = tag.user_text(ALBUM_TYPE_DESCRIPTION)
+    metadata["genre"] = genre_name(tag.text(b"TCON"))
+    metadata["composer"] = tag.text(b"TCOM")
+    metadata["disc_num"] = parse_disc_num(tag.text(b"TPOS"))
+    metadata["release_date"] = tag.release_date()
+    metadata["original_release_date"] = tag.original_release_date()
+    metadata["recording_date"] = tag.recording_date()
+
+    metadata["artworks"] = []
+    for i in range(tag.pictures_count if max_artworks is None else min(max_artworks, tag.pictures_count)):
+        with tag.picture(i) as image_data:
+            metadata["artworks"].append(save_artwork(image_data))
+
+    return metadata
+
+
+@contextlib.contextmanager
+def mapped(file_path: Union[Path, str]):
+    # read-only mapping of the file, empty files (they can't be mapped) are returned as b""
+    with open(file_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b""
+            return
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            try:
+                data.close()
+            except BufferError:
+                # a traceback still references a view of the file: it's unmapped when that's collected
+                pass
+
+
+def read_mp3(file_path: Union[Path, str], save_artwork: Callable, max_artworks: Optional[int] = None) -> Optional[dict]:
+    # same keys metadata.scan_file() fills with eyed3. `save_artwork` is called with the image data of the first
+    # `max_artworks` pictures (all if None) while the file is still mapped, and returns what to store in "artworks".
+    # None: not an mp3 file
+    with mapped(file_path) as data:
+        if not data:
+            return
+
+        return read_mapped(data, save_artwork, max_artworks)
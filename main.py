@@ -1,19 +1,26 @@
 import io
 import os
 from pathlib import Path
+import time
 import asyncio
 import datetime
-from typing import Optional, Union, List
-from typing import TypedDict
-
-import eyed3
-from eyed3.id3.frames import ImageFrame
-from eyed3.mp3 import Mp3AudioFile
-from pyrogram import Client
-from pyrogram.errors import FloodWait
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union, List, Tuple
+from typing import TypedDict, NamedTuple
+
+from pyrogram import Client, raw, types, utils
+from pyrogram.errors import FilePartMissing, FileReferenceExpired, FileReferenceInvalid, MediaEmpty
 from tqdm import tqdm
 
 import utilities as utilities
+import metadata as metadata
+import artwork as artwork
+import uploads as uploads
+import accounts as accounts
+import metrics as metrics
+import watcher as watcher
+from ratelimit import Scheduler
+from pins import DeferredPinner
 from config import config
 
 logger = utilities.get_logger(__file__)
@@ -27,72 +34,184 @@ class Id2Kwargs(TypedDict):
     caption: Optional[str]
 
 
+class PreparedFile(NamedTuple):
+    id3_kwargs: Union[Id2Kwargs, bool]  # False: the file can't be uploaded
+    content_hash: Optional[str]
+
+
+class UploadJob(NamedTuple):
+    seq: int  # position in the posting order
+    file_index: int  # position in the walk of the tracks directory
+    file_path: Path
+    size: int
+    new_dir: bool  # whether the directory name message should be posted before the track
+    account: accounts.Account  # the bot that uploads and posts the track, the same for the whole directory
+    prepared: asyncio.Task  # prepare_audio_file(), started as soon as the job is queued
+
+
 class FileName:
     PROCESSED_TRACKS = "data/processed-tracks.json"
     POSTED_MESSAGES = "data/posted-messages.json"
+    WALK_CURSOR = "data/walk-cursor.json"
+    UPLOADED_FILES = "data/uploaded-files.json"
+    DEFERRED_TRACKS = "data/deferred-tracks.json"
+
+
+FILE_SIZE_LIMIT_MIB = uploads.FILE_SIZE_LIMIT_MIB
+UPLOAD_WORKERS = max(1, config.tracks.upload_workers)
+PREFETCH_FILES = max(1, config.tracks.prefetch_files)
+LARGE_FILE_SIZE = config.tracks.large_file_size_mib * 1024 * 1024
+# a single worker has no one to upload the small files while it's busy with a large one: the walk order is kept
+LARGE_UPLOAD_SLOTS = max(0, min(config.tracks.large_upload_slots, UPLOAD_WORKERS - 1))
+WATCH_CHECK_INTERVAL = 1.0  # seconds
+
+# one thread: the files being prepared are read one after the other, in the posting order, instead of making the disk
+# seek between them
+prefetch_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def start_client(name: str, bot_token: str) -> Client:
+    client = Client(
+        name,
+        **config.pyrogram,
+        bot_token=bot_token,
+        workers=1,
+        no_updates=True,
+        max_concurrent_transmissions=UPLOAD_WORKERS
+    )
+    client.start()
 
+    return client
 
-FILE_SIZE_LIMIT_MIB = 2000
 
+def create_account(client: Client) -> accounts.Account:
+    # the scheduler is shared by all the workers using the bot, so a flood wait received by one of them pauses the others
+    # too. Other bots are not affected
+    scheduler = Scheduler(
+        f"data/rate-limits-{client.name}.json",
+        # a pin_chat_message rate in [rate_limits] wins over the cooldown
+        initial_rates={"pin_chat_message": 1 / max(1, config.tracks.message_pinning_cooldown), **config.rate_limits}
+    )
 
-app = Client(**config.pyrogram, **config.bot_account, workers=1, no_updates=True)
-app.start()
+    resumable_uploader: Optional[uploads.ResumableUploader] = None
+    if config.uploads.resumable:
+        resumable_uploader = uploads.ResumableUploader(
+            client,
+            upload_progress,
+            parallel_parts=config.uploads.parallel_parts,
+            max_age=config.uploads.resume_max_age_hours * 3600
+        )
+
+    return accounts.Account(client, scheduler, resumable_uploader)
+
+
+# the metadata scan processes import this file again, as __mp_main__, before running metadata.scan_file(): the clients
+# and the storages are only set up by the actual run
+if __name__ != '__mp_main__':
+    app = start_client(config.bot_account.name, config.bot_account.bot_token)
+
+    processed = utilities.StorageList(FileName.PROCESSED_TRACKS, init_object=[], autosave=True, **config.storage)
+    posted_messages = utilities.StoragMessages(FileName.POSTED_MESSAGES, autosave=True, **config.storage)
+    uploaded_files = utilities.StorageUploadedFiles(FileName.UPLOADED_FILES, autosave=True, **config.storage)
+    metadata_cache = metadata.MetadataCache(artworks_max_size=config.metadata.artworks_max_size_mib * 1024 * 1024, **config.storage)
+    # only the first artwork is used, for the thumbnail
+    metadata_scanner = metadata.MetadataScanner(metadata_cache, config.metadata.scan_workers, max_artworks=1)
+    walk_cursor = utilities.StorageWalkCursor(FileName.WALK_CURSOR, config.tracks.path, fsync=config.storage.fsync, fsync_interval=config.storage.fsync_interval)
+    deferred_files = utilities.StorageDeferredFiles(FileName.DEFERRED_TRACKS, config.tracks.path)
+    deferred_files.prune(processed)
+    thumbnails = artwork.ThumbnailCache(config.thumbnails.cache_max_size_mib * 1024 * 1024, config.thumbnails.memory_items)
+
+    upload_progress = uploads.StorageUploadProgress(**config.storage)
+
+    account_pool = accounts.AccountPool(
+        [create_account(app)] + [
+            create_account(start_client(f"{config.bot_account.name}-{i + 2}", bot_token))
+            for i, bot_token in enumerate(config.sharding.bot_tokens)
+        ],
+        max_flood_wait=config.sharding.max_flood_wait
+    )
+    scheduler = account_pool.main.scheduler
 
-processed = utilities.StorageList(FileName.PROCESSED_TRACKS, init_object=[], autosave=True)
-posted_messages = utilities.StoragMessages(FileName.POSTED_MESSAGES, autosave=True)
+    pinner: Optional[DeferredPinner] = None
+    if config.tracks.defer_pins:
+        pinner = DeferredPinner(app, scheduler, config.telegram.chat_id, config.tracks.pins_delete_batch_size)
 
-DEFAULT_THUMBNAIL: Optional[io.BytesIO] = None
-if config.tracks.default_thumbnail_path:
-    try:
-        with open(config.tracks.default_thumbnail_path, "rb") as f:
-            DEFAULT_THUMBNAIL = io.BytesIO(f.read())
-    except FileNotFoundError:
-        logger.warning(f"unable to find default thumbnail file: {config.tracks.default_thumbnail_path}")
+    DEFAULT_THUMBNAIL: Optional[bytes] = None
+    if config.tracks.default_thumbnail_path:
+        try:
+            with open(config.tracks.default_thumbnail_path, "rb") as f:
+                DEFAULT_THUMBNAIL = artwork.prepare_thumbnail(f.read())
+        except FileNotFoundError:
+            logger.warning(f"unable to find default thumbnail file: {config.tracks.default_thumbnail_path}")
 
 
-class ProgressBar:
+class RunProgress:
+    # bytes uploaded by all the workers since the start of the run. The tracks directory is walked lazily, so the ETA
+    # only covers the files queued so far
     def __init__(self):
+        self.started = time.monotonic()
+        self.queued_bytes = 0
+        self.uploaded_bytes = 0
+
+    def queue(self, size: int):
+        self.queued_bytes += size
+
+    def skip(self, size: int):
+        # files re-sent by file_id are not uploaded
+        self.queued_bytes -= size
+
+    @property
+    def speed(self) -> float:
+        # bytes per second
+        return self.uploaded_bytes / max(0.001, time.monotonic() - self.started)
+
+    def __str__(self):
+        speed = self.speed
+        eta = datetime.timedelta(seconds=int(max(0, self.queued_bytes - self.uploaded_bytes) / speed)) if speed else "-"
+        return f"run: {speed / 1024 / 1024:.2f} MB/s, eta: {eta}"
+
+
+run_progress = RunProgress()
+
+
+class ProgressBar:
+    def __init__(self, position=0):
         self.last_update_perc = 0
+        self.last_current = 0
+        self.last_refresh = 0.0
+        self.last_refresh_current = 0
+        self.position = position
         self.tqdm = None
 
 
 async def progress(current, total, progress_bar: ProgressBar):
+    # called for every uploaded chunk: only the byte counters are updated every time, the bar and the log are refreshed
+    # once every refresh_interval seconds or refresh_bytes_mib MiB, and when the upload completes
+    run_progress.uploaded_bytes += current - progress_bar.last_current
+    progress_bar.last_current = current
+
+    now = time.monotonic()
+    if (
+            current < total
+            and now - progress_bar.last_refresh < config.progress.refresh_interval
+            and current - progress_bar.last_refresh_current < config.progress.refresh_bytes_mib * 1024 * 1024
+    ):
+        return
+
+    progress_bar.last_refresh = now
+    progress_bar.last_refresh_current = current
+
     if not progress_bar.tqdm:
-        progress_bar.tqdm = tqdm(total=100, leave=False, bar_format="[{bar}]{percentage:3.0f}% (elapsed: {elapsed})")
+        progress_bar.tqdm = tqdm(total=100, leave=False, position=progress_bar.position, bar_format="[{bar}]{percentage:3.0f}% (elapsed: {elapsed}, {postfix})")
 
     proggress_perc = current * 100 / total
     progress_step = proggress_perc - progress_bar.last_update_perc
     progress_bar.last_update_perc = proggress_perc
 
+    progress_bar.tqdm.set_postfix_str(str(run_progress), refresh=False)
     progress_bar.tqdm.update(progress_step)
 
-    logger.debug(f"{proggress_perc:.1f}%")
-
-
-def override_artwork(audio_file):
-    # if p.name.startswith("B"):
-
-    audio_file.tag.images.set(
-        ImageFrame.FRONT_COVER,
-        open('thumb.jpg', 'rb').read(),
-        "image/jpeg", u"artwork"
-    )
-    audio_file.tag.save()
-
-
-def extract_date(audio_file: Mp3AudioFile):
-    # date fields are actually datetime objects, we don't care about the time so we only return the date
-    if audio_file.tag.original_release_date:
-        tag_date = audio_file.tag.original_release_date
-    elif audio_file.tag.release_date:
-        tag_date = audio_file.tag.release_date
-    elif audio_file.tag.recording_date:
-        tag_date = audio_file.tag.recording_date
-    else:
-        return
-
-    if tag_date.year:
-        return tag_date.year
+    logger.debug(f"{proggress_perc:.1f}% ({run_progress})")
 
 
 def artist_from_path(file_path: Path, join: str, remove_first_n_directories: int = 0) -> Optional[str]:
@@ -107,172 +226,530 @@ def artist_from_path(file_path: Path, join: str, remove_first_n_directories: int
     return join.join(parts_list_no_leading_dirs)
 
 
-async def process_audio_file(file_path: Path, current_file_index: int, files_count: int):
-    logger.info(f"{file_path.parent} -> {file_path.name}")
+async def read_audio_file(file_path: Path) -> Union[Id2Kwargs, bool]:
+    # tags are parsed in the scanner's process pool as soon as the file is queued, and cached
+    with metrics.span("read_metadata"):
+        entry = await metadata_scanner.load(file_path)
 
-    # load() might return None if the mime type is not recognized
-    # http://eyed3.readthedocs.io/en/latest/eyed3.html#eyed3.core.load
-    try:
-        audio_file: Optional[Mp3AudioFile] = eyed3.load(file_path)
-    except UnicodeDecodeError:
+    logger.info(f"{file_path.parent} -> {file_path.name}")
+    if entry["error"] == "UnicodeDecodeError":
         # must investigate
         logger.warning(f"UnicodeDecodeError while decoding metadata for file {file_path}")
-        audio_file = None
+    elif entry["error"] and entry["error"] != "not_loaded":
+        logger.warning(f"{entry['error']} while decoding metadata for file {file_path}")
+
+    audio_metadata = entry["metadata"]
 
-    if audio_file and audio_file.info and audio_file.info.size_bytes:
-        size_str = utilities.human_readable_size(audio_file.info.size_bytes)
+    if audio_metadata.get("size_bytes"):
+        size_str = utilities.human_readable_size(audio_metadata["size_bytes"])
         logger.info(f"\tsize:     {size_str}")
-        if audio_file.info.size_bytes > FILE_SIZE_LIMIT_MIB * 1024 * 1024:
+        if audio_metadata["size_bytes"] > FILE_SIZE_LIMIT_MIB * 1024 * 1024:
             logger.warning(f"file is too big")
             logger.warning(f"send it manually and add it to {FileName.PROCESSED_TRACKS} and {FileName.POSTED_MESSAGES}")
             return False
 
-    if DEFAULT_THUMBNAIL:
-        DEFAULT_THUMBNAIL.seek(0)
-
     id3_kwargs: Id2Kwargs = dict(
         title=file_path.stem,  # stem = no extension
         performer=artist_from_path(file_path, " - ", config.tracks.remove_first_n_directories_from_path_artist),
-        thumb=DEFAULT_THUMBNAIL,
+        # every upload gets its own copy: workers might read the thumbnail concurrently
+        thumb=io.BytesIO(DEFAULT_THUMBNAIL) if DEFAULT_THUMBNAIL else None,
         caption=None,
-        duration=int(audio_file.info.time_secs) if audio_file and audio_file.info and audio_file.info.time_secs else 0
+        duration=int(audio_metadata["time_secs"]) if audio_metadata.get("time_secs") else 0
     )
 
     logger.opt(colors=True).info(f"\tduration: {datetime.timedelta(seconds=id3_kwargs['duration']) or '<r>not found</r>'}")
 
-    if not audio_file or not audio_file.tag:
+    # "artworks" is only set when the file has a tag
+    if "artworks" not in audio_metadata:
         logger.info(f"\ttitle:    {id3_kwargs['title']}")
         logger.info(f"\tartist:   {id3_kwargs['performer']}")
         logger.opt(colors=True).info(f"\t<r>couldn't load id3 metadata</r>")
     else:
         # do not clorize these tags: https://github.com/Delgan/loguru/issues/140
 
-        if audio_file.tag.title:
-            logger.info(f"\ttitle:    [ID3] {audio_file.tag.title}")
-            id3_kwargs["title"] = audio_file.tag.title
+        if audio_metadata["title"]:
+            logger.info(f"\ttitle:    [ID3] {audio_metadata['title']}")
+            id3_kwargs["title"] = audio_metadata["title"]
         else:
             logger.info(f"\ttitle:    {id3_kwargs['title']}")
 
-        if audio_file.tag.artist:
-            logger.info(f"\tartist:   [ID3] {audio_file.tag.artist}")
-            id3_kwargs["performer"] = audio_file.tag.artist
+        if audio_metadata["artist"]:
+            logger.info(f"\tartist:   [ID3] {audio_metadata['artist']}")
+            id3_kwargs["performer"] = audio_metadata["artist"]
         else:
             logger.info(f"\tartist:   {id3_kwargs['performer']}")
 
-        logger.info(f"\talbum:    {audio_file.tag.album or '-'}")
-        if audio_file.tag.album:
-            id3_kwargs["caption"] = f"💽 {audio_file.tag.album}"
-            album_year = extract_date(audio_file)
+        logger.info(f"\talbum:    {audio_metadata['album'] or '-'}")
+        if audio_metadata["album"]:
+            id3_kwargs["caption"] = f"💽 {audio_metadata['album']}"
+            album_year = metadata.extract_year(audio_metadata)
             if album_year:
                 id3_kwargs["caption"] += f" ({album_year})"
 
-        if not audio_file.tag.images:
+        if not audio_metadata["artworks"]:
             logger.info(f"\tartwork:  -")
         else:
-            thumb = io.BytesIO(audio_file.tag.images[0].image_data)
-
-            thumb.seek(0, os.SEEK_END)
-            file_size = thumb.tell()
-            thumb.seek(0)
+            # prepared once per cover, every track of the album reuses it
+            with metrics.span("thumbnail"):
+                thumb = await asyncio.get_running_loop().run_in_executor(None, thumbnails.get, audio_metadata["artworks"][0])
 
-            if file_size != 0:
-                id3_kwargs["thumb"] = thumb
+            if thumb:
+                id3_kwargs["thumb"] = io.BytesIO(thumb)
                 logger.info(f"\tartwork:  found")
             else:
-                logger.opt(colors=True).info(f"\tartwork:  <r>thumbnail found, but size is 0</r>")
+                logger.opt(colors=True).info(f"\tartwork:  <r>thumbnail found, but it's empty or it can't be decoded</r>")
+
+    return id3_kwargs
 
-    retry = True
-    while retry:
-        try:
-            logger.opt(colors=True).info("<g>uploading...</g>")
-            progress_bar = ProgressBar()
-            message = await app.send_audio(
-                config.telegram.chat_id,
-                file_path,
-                file_name=file_path.name,
-                disable_notification=True,
-                progress=progress,
-                progress_args=(progress_bar,),
-                **id3_kwargs
-            )
-            logger.opt(colors=True).info(f"<g>...upload completed</g>, {files_count - current_file_index} pending")
-            processed.add(file_path)
-            posted_messages.add(message.id, file_path)
-            retry = False
-            progress_bar.tqdm.close()
-        except FloodWait as e:
-            logger.opt(colors=True).info(f"<r>flood_wait: will retry in {e.value} seconds</r>")
-            await asyncio.sleep(e.value + 180)
 
+async def upload_audio_file(account: accounts.Account, file_path: Path, id3_kwargs: Id2Kwargs, progress_bar: ProgressBar) -> raw.types.InputMediaUploadedDocument:
+    # only pushes the file to Telegram's servers: it can run concurrently, the message is posted by post_audio_file()
+    # with the same account
+    logger.opt(colors=True).info(f"<g>uploading...</g> {file_path.name} ({account.name})")
 
-async def send_dir_name(file_path: Path, pin=True):
+    file_size = file_path.stat().st_size
+    with metrics.span("upload", account=account.name, size=file_size):
+        thumb = await account.client.save_file(id3_kwargs["thumb"])
+        if account.resumable_uploader and file_size > max(uploads.BIG_FILE_SIZE, config.uploads.resumable_min_size_mib * 1024 * 1024):
+            file = await account.resumable_uploader.save_file(file_path, progress=progress, progress_args=(progress_bar,))
+        else:
+            file = await account.client.save_file(file_path, progress=progress, progress_args=(progress_bar,))
+    if not file:
+        # save_file() logs and swallows errors
+        raise ValueError(f"upload of {file_path} failed")
+
+    metrics.inc("uploaded_files")
+    metrics.inc("uploaded_bytes", file_size)
+
+    return raw.types.InputMediaUploadedDocument(
+        mime_type=app.guess_mime_type(file_path.name) or "audio/mpeg",
+        file=file,
+        thumb=thumb,
+        attributes=[
+            raw.types.DocumentAttributeAudio(
+                duration=id3_kwargs["duration"],
+                performer=id3_kwargs["performer"],
+                title=id3_kwargs["title"]
+            ),
+            raw.types.DocumentAttributeFilename(file_name=file_path.name)
+        ]
+    )
+
+
+async def post_audio_file(account: accounts.Account, file_path: Path, media: raw.base.InputMedia, caption: Optional[str]) -> types.Message:
+    client = account.client
+    peer = await client.resolve_peer(config.telegram.chat_id)
+
+    while True:
+        try:
+            with metrics.span("post", account=account.name):
+                r = await account.scheduler.call(
+                    "send_audio",
+                    client.invoke,
+                    raw.functions.messages.SendMedia(
+                        peer=peer,
+                        media=media,
+                        silent=True,
+                        random_id=client.rnd_id(),
+                        **await utils.parse_text_entities(client, caption or "", None, None)
+                    )
+                )
+        except FilePartMissing as e:
+            metrics.inc("retries")
+            await client.save_file(file_path, file_id=media.file.id, file_part=e.value)
+            continue
+
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    client, update.message,
+                    {i.id: i for i in r.users},
+                    {i.id: i for i in r.chats}
+                )
+
+
+async def upload_or_reuse_audio_file(
+        account: accounts.Account,
+        file_path: Path,
+        id3_kwargs: Id2Kwargs,
+        progress_bar: ProgressBar,
+        content_hash: Optional[str] = None
+) -> Tuple[raw.base.InputMedia, str]:
+    # identical files (eg. the same track in a compilation) are re-sent by file_id instead of being uploaded again
+    if not content_hash:
+        with metrics.span("hash_file"):
+            content_hash = await asyncio.get_running_loop().run_in_executor(None, utilities.hash_file, file_path)
+
+    uploaded_file = uploaded_files.get(content_hash, account.name)
+    if uploaded_file:
+        logger.info(f"\tsame content as message {uploaded_file['message_id']}: sending it by file_id")
+        metrics.inc("reused_files")
+        run_progress.skip(file_path.stat().st_size)
+        return utils.get_input_media_from_file_id(uploaded_file["file_id"]), content_hash
+
+    return await upload_audio_file(account, file_path, id3_kwargs, progress_bar), content_hash
+
+
+async def save_posted_audio(
+        account: accounts.Account,
+        file_path: Path,
+        media: raw.base.InputMedia,
+        content_hash: str,
+        id3_kwargs: Id2Kwargs,
+        progress_bar: ProgressBar,
+        file_index: int,
+        update_cursor=True
+):
+    try:
+        message = await post_audio_file(account, file_path, media, id3_kwargs["caption"])
+    except (FileReferenceExpired, FileReferenceInvalid, MediaEmpty) as e:
+        if isinstance(media, raw.types.InputMediaUploadedDocument):
+            raise
+
+        logger.warning(f"stored file_id can't be used anymore ({e.ID}), uploading the file again")
+        metrics.inc("retries")
+        media = await upload_audio_file(account, file_path, id3_kwargs, progress_bar)
+        message = await post_audio_file(account, file_path, media, id3_kwargs["caption"])
+
+    logger.opt(colors=True).info(f"<g>...upload completed</g>: {file_path.name} (file #{file_index})")
+    metrics.inc("posted_files")
+    processed.add(file_path)
+    posted_messages.add(message.id, file_path)
+    deferred_files.remove(file_path)
+    if isinstance(media, raw.types.InputMediaUploadedDocument):
+        uploaded_files.add(content_hash, message, account.name)
+    if account.resumable_uploader:
+        account.resumable_uploader.done(file_path)
+
+    # tracks are posted in the walk order, so every file before this one has been handled
+    if update_cursor and config.tracks.resume_walk:
+        walk_cursor.set(utilities.relative_parts(file_path, config.tracks.path))
+    if progress_bar.tqdm:
+        progress_bar.tqdm.close()
+
+
+async def process_audio_file(file_path: Path, current_file_index: int, account: Optional[accounts.Account] = None, update_cursor=True):
+    account = account or account_pool.main
+    id3_kwargs = await read_audio_file(file_path)
+    if id3_kwargs is False:
+        return False
+
+    progress_bar = ProgressBar()
+    media, content_hash = await upload_or_reuse_audio_file(account, file_path, id3_kwargs, progress_bar)
+    await save_posted_audio(account, file_path, media, content_hash, id3_kwargs, progress_bar, current_file_index, update_cursor)
+
+
+async def prepare_audio_file(file_path: Path) -> PreparedFile:
+    # runs while the previous files are being uploaded: tags, thumbnail and content hash are ready when a worker picks
+    # the file up. Hashing reads the whole file, which also leaves it in the page cache for the upload
+    id3_kwargs = await read_audio_file(file_path)
+    if id3_kwargs is False:
+        return PreparedFile(False, None)
+
+    with metrics.span("hash_file"):
+        content_hash = await asyncio.get_running_loop().run_in_executor(prefetch_executor, utilities.hash_file, file_path)
+
+    return PreparedFile(id3_kwargs, content_hash)
+
+
+async def send_dir_name(file_path: Path, pin=True, account: Optional[accounts.Account] = None):
+    account = account or account_pool.main
     text = artist_from_path(file_path, " -> ", config.tracks.remove_first_n_directories_from_path)
-    message = await app.send_message(config.telegram.chat_id, text, disable_web_page_preview=True)
+
+    with metrics.span("send_dir_name", account=account.name):
+        message = await account.scheduler.call("send_message", account.client.send_message, config.telegram.chat_id, text, disable_web_page_preview=True)
     posted_messages.add(message.id, message.text)
 
     if not pin:
         return
 
-    retry = True
-    while retry:
+    if pinner:
+        # pinned in the background, the tracks don't have to wait
+        pinner.pin(message.id)
+        return
+
+    # no fixed sleep after pinning: the scheduler spaces the pins according to the budget it learned
+    logger.info(f"pinning message {message.id}...")
+    service_message = await account.scheduler.call("pin_chat_message", message.pin, disable_notification=True)
+    await account.scheduler.call("delete_messages", service_message.delete)
+
+
+async def stop_on_error(job: UploadJob, e: Exception, jobs: utilities.UploadQueue, posting_order: utilities.PostingOrder):
+    posting_order.stop()
+    await jobs.close()
+    logger.opt(exception=e).error(f"an error occurred while processing a file: {e}")
+    await scheduler.call("send_message", app.send_message, config.telegram.chat_id, f"error while processing {job.file_path}: {e}")
+
+
+async def post_job(job: UploadJob, media: Optional[raw.base.InputMedia], prepared: PreparedFile, progress_bar: ProgressBar, jobs: utilities.UploadQueue, posting_order: utilities.PostingOrder):
+    try:
+        async with posting_order.turn(job.seq):
+            if posting_order.stopped:
+                return
+
+            # the directory message must land before the directory's tracks
+            if job.new_dir:
+                logger.opt(colors=True).info(f"<g>new dir: {list(job.file_path.parts)[:-1]}</g>")
+                await send_dir_name(job.file_path, pin=True, account=job.account)
+
+            if not media:
+                # the file grew past the limit after it was queued
+                deferred_files.add(job.file_path, "too big")
+                return
+
+            await save_posted_audio(job.account, job.file_path, media, prepared.content_hash, prepared.id3_kwargs, progress_bar, job.file_index)
+    except Exception as e:
+        await stop_on_error(job, e, jobs, posting_order)
+        raise
+    finally:
+        await jobs.posted()
+
+
+async def upload_worker(worker_index: int, jobs: utilities.UploadQueue, posting_order: utilities.PostingOrder, posts: List[asyncio.Task]):
+    while not posting_order.stopped:
+        job: Optional[UploadJob] = await jobs.get()
+        if job is None:
+            return
+
+        media = None
+        progress_bar = ProgressBar(position=worker_index)
         try:
-            logger.info(f"pinning message {message.id} (and then sleeping {config.tracks.message_pinning_cooldown} seconds)...")
-            service_message = await message.pin(disable_notification=True)
-            retry = False
-            await service_message.delete()
+            prepared: PreparedFile = await job.prepared
+            if prepared.id3_kwargs is not False:
+                media, content_hash = await upload_or_reuse_audio_file(job.account, job.file_path, prepared.id3_kwargs, progress_bar, prepared.content_hash)
+                prepared = prepared._replace(content_hash=content_hash)
+        except Exception as e:
+            await stop_on_error(job, e, jobs, posting_order)
+            raise
+        finally:
+            jobs.uploaded(job)
 
-            # always sleep after pinning
-            await asyncio.sleep(config.tracks.message_pinning_cooldown)
-        except FloodWait as e:
-            logger.opt(colors=True).info(f"<r>flood_wait while pinning: will retry in {e.value} seconds</r>")
-            await asyncio.sleep(e.value + 5)
+        # the worker doesn't wait for the track to be posted: it moves on to the next file while the previous ones (eg. a
+        # large file uploaded by another worker) are still in flight. Finished posts are dropped, failed ones are kept
+        # for main() to see
+        posts[:] = [task for task in posts if not task.done() or task.cancelled() or task.exception()]
+        posts.append(asyncio.create_task(post_job(job, media, prepared, progress_bar, jobs, posting_order)))
 
 
-async def main():
-    tracks_path = Path(config.tracks.path)
-    last_dir_name = ""
+def log_ignored_file(file_path: Path):
+    logger.opt(colors=True).info(f"<y>{file_path.suffix} file ignored</y>: {file_path.parent} -> {file_path.name}")
+
+
+async def queue_files(jobs: utilities.UploadQueue, posting_order: utilities.PostingOrder) -> int:
+    # walks the tracks directory lazily, so the first upload can start right away
     allowed_extensions = tuple(config.tracks.allowed_extensions)
     logger.info(f"allowed extensions: {allowed_extensions}")
 
-    paths_list: List[Path] = []
+    start_after = walk_cursor.get() if config.tracks.resume_walk else None
+    if start_after:
+        logger.info(f"resuming after {start_after} (delete {FileName.WALK_CURSOR} to walk the whole directory)")
 
-    for file_path in tracks_path.rglob("*"):
-        if file_path.is_dir():
-            continue
+    files = utilities.walk_files(config.tracks.path, allowed_extensions, start_after=start_after, on_ignored=log_ignored_file)
+    loop = asyncio.get_running_loop()
 
-        if not file_path.name.lower().endswith(allowed_extensions):
-            logger.opt(colors=True).info(f"<y>{file_path.suffix} file ignored</y>: {file_path.parent} -> {file_path.name}")
-            continue
+    last_dir_name = ""
+    account = account_pool.main
+    jobs_count = 0
+    file_index = 0
+    try:
+        while not posting_order.stopped:
+            # reading directories is blocking I/O (and slow on network mounts): keep it off the event loop
+            file_path: Optional[Path] = await loop.run_in_executor(None, next, files, None)
+            if not file_path:
+                break
+
+            file_index += 1
+            if processed.exists(file_path):
+                logger.debug(f"skipping file {file_path}: already processed")
+                continue
+
+            file_size = await loop.run_in_executor(None, os.path.getsize, file_path)
+            if file_size > FILE_SIZE_LIMIT_MIB * 1024 * 1024:
+                # the rest of the directory is still uploaded
+                logger.warning(f"file is too big, skipped: {file_path} ({utilities.human_readable_size(file_size)})")
+                deferred_files.add(file_path, "too big")
+                continue
+
+            metadata_scanner.prefetch(file_path)
+            run_progress.queue(file_size)
+
+            parent_dir_name = file_path.parents[0]
+            new_dir = parent_dir_name != last_dir_name
+            if new_dir:
+                account = account_pool.pick()
+
+            # waits while PREFETCH_FILES jobs are already queued and not posted, which bounds how many files are prepared
+            # ahead
+            job = UploadJob(
+                seq=jobs_count,
+                file_index=file_index,
+                file_path=file_path,
+                size=file_size,
+                new_dir=new_dir,
+                account=account,
+                prepared=asyncio.create_task(prepare_audio_file(file_path))
+            )
+            if not await jobs.put(job):
+                # the run has been stopped
+                job.prepared.cancel()
+                break
 
-        paths_list.append(file_path)
+            last_dir_name = parent_dir_name
+            jobs_count += 1
+    except Exception as e:
+        logger.opt(exception=e).error(f"an error occurred while walking {config.tracks.path}: {e}")
+        posting_order.stop()
 
-    files_count = len(paths_list)
-    logger.info(f"found {files_count} files to process")
+        # wake up the idle workers, the others will notice the run has been stopped
+        await jobs.close()
+        raise
 
-    for i, file_path in enumerate(paths_list):
-        if processed.exists(file_path):
-            logger.debug(f"skipping file {file_path}: already processed")
-            continue
+    # the workers exit once the queued jobs are done
+    await jobs.close()
 
-        parent_dir_name = file_path.parents[0]
-        if parent_dir_name != last_dir_name:
-            logger.opt(colors=True).info(f"<g>new dir: {list(file_path.parts)[:-1]}</g>")
+    return jobs_count
 
-            await send_dir_name(file_path, pin=True)
 
-            last_dir_name = parent_dir_name
+def needs_dir_name(file_path: Path) -> bool:
+    # false if the last message in the channel is the directory message or a track of the file's directory
+    last_message = posted_messages.last()
+    if not last_message:
+        return True
+
+    if last_message["origin_audio_path"]:
+        return Path(*last_message["origin_audio_path"]).parent != file_path.parent
+
+    return last_message["text"] != artist_from_path(file_path, " -> ", config.tracks.remove_first_n_directories_from_path)
+
+
+async def upload_new_files(file_paths: List[Path], first_file_index: int) -> Optional[int]:
+    # the settled files of a directory. Files can arrive in any order, and interleaved with other directories: they are
+    # posted in the walk order, and the directory message is posted again if something else has been posted since the
+    # directory's last track. None: stopped by an error
+    allowed_extensions = tuple(config.tracks.allowed_extensions)
+    file_paths = sorted(file_paths, key=lambda p: utilities.walk_key(utilities.relative_parts(p, config.tracks.path)))
+    account = account_pool.pick()
+
+    file_index = first_file_index
+    for file_path in file_paths:
+        if not file_path.name.lower().endswith(allowed_extensions) or processed.exists(file_path):
+            continue
 
         try:
-            continue_execution = await process_audio_file(file_path, i + 1, files_count)
+            file_size = file_path.stat().st_size
+        except OSError as e:
+            # removed or renamed since it settled: a rename is seen as a new file
+            logger.warning(f"{type(e).__name__}, skipped: {file_path}")
+            continue
+
+        if file_size > FILE_SIZE_LIMIT_MIB * 1024 * 1024:
+            logger.warning(f"file is too big, skipped: {file_path}")
+            deferred_files.add(file_path, "too big")
+            continue
+
+        file_index += 1
+        try:
+            if needs_dir_name(file_path):
+                logger.opt(colors=True).info(f"<g>new dir: {list(file_path.parts)[:-1]}</g>")
+                await send_dir_name(file_path, pin=True, account=account)
+
+            # the walk cursor is left alone: files arrive out of the walk order
+            if await process_audio_file(file_path, file_index, account, update_cursor=False) is False:
+                deferred_files.add(file_path, "too big")
         except Exception as e:
+            # the settled files are not handed out again: the daemon stops like the first pass does, the rest of the
+            # directory is uploaded by the next run, in order
             logger.opt(exception=e).error(f"an error occurred while processing a file: {e}")
-            await app.send_message(config.telegram.chat_id, f"error while processing {file_path}: {e}")
-            return  # terminate on fail
-
-        if continue_execution is False:
-            # if None is returned, do NOT exit
-            logger.warning("exiting")
+            await scheduler.call("send_message", app.send_message, config.telegram.chat_id, f"error while processing {file_path}: {e}")
             return
 
+    return file_index
+
+
+async def watch_files(settled_files: watcher.SettledFiles):
+    logger.info(f"waiting for new files in {config.tracks.path}...")
+    file_index = 0
+    while True:
+        await asyncio.sleep(WATCH_CHECK_INTERVAL)
+        for file_paths in settled_files.pop_settled():
+            file_index = await upload_new_files(file_paths, file_index)
+            if file_index is None:
+                logger.error("stopped watching: restart the script to upload the remaining files")
+                return
+
+
+async def upload_files() -> bool:
+    # one pass over the tracks directory. False: the run has been stopped by an error
+    # bounded: files are walked (and prepared) just a little ahead of the posts
+    jobs = utilities.UploadQueue(PREFETCH_FILES, LARGE_FILE_SIZE, LARGE_UPLOAD_SLOTS)
+    posting_order = utilities.PostingOrder()
+    posts: List[asyncio.Task] = []
+
+    producer = asyncio.create_task(queue_files(jobs, posting_order))
+    workers = [asyncio.create_task(upload_worker(i, jobs, posting_order, posts)) for i in range(UPLOAD_WORKERS)]
+    try:
+        await asyncio.gather(*workers)
+        # the last tracks might still be waiting for their turn
+        await asyncio.gather(*posts)
+    except Exception:
+        # the failing worker already reported the error
+        for task in workers + posts + [producer]:
+            task.cancel()
+        return False  # terminate on fail
+    finally:
+        # jobs left in the queue when the run stops early
+        for job in jobs.drain():
+            job.prepared.cancel()
+
+    if producer.done() and not producer.cancelled() and producer.exception():
+        return False
+
+    # the producer is only still running if the workers stopped early
+    producer.cancel()
+
+    if posting_order.stopped:
+        logger.warning("exiting")
+        return False
+
+    if len(deferred_files):
+        logger.warning(f"{len(deferred_files)} files have been skipped, see {FileName.DEFERRED_TRACKS}. Send them manually and run script_reconcile.py")
+
+    logger.info(f"{producer.result()} files uploaded ({utilities.human_readable_size(run_progress.uploaded_bytes)}, {run_progress.speed / 1024 / 1024:.2f} MB/s)")
+    return True
+
+
+async def main():
+    if config.metrics.trace:
+        metrics.registry.open_trace(f"logs/trace_{datetime.datetime.now():%Y%m%d_%H%M%S}.jsonl")
+
+    metrics_server = None
+    if config.metrics.serve:
+        metrics_server = await metrics.serve(config.metrics.host, config.metrics.port)
+
+    if pinner:
+        pinner.start()
+
+    files_watcher = None
+    settled_files = watcher.SettledFiles(config.watch.settle_seconds)
+    if config.watch.enabled:
+        # started before the walk: files added while it runs are not missed (the ones it uploads are skipped later)
+        files_watcher = watcher.create(config.tracks.path, settled_files.touch, config.watch.backend, config.watch.poll_interval)
+
+    try:
+        if await upload_files() and files_watcher:
+            await watch_files(settled_files)
+    finally:
+        if files_watcher:
+            files_watcher.close()
+
+        walk_cursor.flush()
+        metadata_scanner.shutdown()
+        prefetch_executor.shutdown(cancel_futures=True)
+        if pinner:
+            await pinner.close()
+        if metrics_server:
+            metrics_server.close()
+        metrics.registry.close()
+
 if __name__ == '__main__':
     app.run(main())
@@ -0,0 +1,336 @@
+import os
+import asyncio
+import hashlib
+import functools
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Union, List, Iterable
+from typing import TypedDict
+
+import eyed3
+from eyed3.mp3 import Mp3AudioFile
+from loguru import logger
+
+import utilities as utilities
+import metrics as metrics
+import tagreaders as tagreaders
+import id3tags as id3tags
+
+
+class FileName:
+    METADATA_CACHE = "data/metadata-cache.json"
+    ARTWORKS_DIR = "data/artworks"
+
+
+# entries of formats handled by tagreaders that were scanned by an older version are scanned again
+SCAN_VERSION = 2
+
+
+class CacheEntry(TypedDict):
+    size: int
+    mtime_ns: int
+    version: int
+    error: Optional[str]  # exception name (eg. "UnicodeDecodeError") or "not_loaded" if eyed3 couldn't read the file
+    metadata: dict  # same keys used by script_metadata_to_json, "artworks" is a list of hashes
+    artworks_limit: Optional[int]  # only the first n artworks were read, missing: all of them
+
+
+def artwork_path(artwork_hash: str, artworks_dir=FileName.ARTWORKS_DIR) -> str:
+    return os.path.join(artworks_dir, artwork_hash)
+
+
+def touch_artwork(artwork_hash: str, artworks_dir=FileName.ARTWORKS_DIR) -> bool:
+    # the mtime is used to evict the least recently used artworks. False: the artwork is missing
+    try:
+        os.utime(artwork_path(artwork_hash, artworks_dir))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def save_artwork(image_data: Union[bytes, memoryview], artworks_dir=FileName.ARTWORKS_DIR) -> str:
+    # artworks are stored once per content, albums repeat the same cover on every track
+    artwork_hash = hashlib.sha1(image_data).hexdigest()
+    if not touch_artwork(artwork_hash, artworks_dir):
+        # other scan processes might be writing the same artwork
+        file_path = artwork_path(artwork_hash, artworks_dir)
+        tmp_file_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(tmp_file_path, "wb") as f:
+            f.write(image_data)
+        os.replace(tmp_file_path, file_path)
+
+    return artwork_hash
+
+
+def read_artwork(artwork_hash: str) -> Optional[bytes]:
+    try:
+        with open(artwork_path(artwork_hash), "rb") as f:
+            image_data = f.read()
+    except FileNotFoundError:
+        return
+
+    touch_artwork(artwork_hash)
+    return image_data
+
+
+def extract_year(metadata: dict) -> Optional[int]:
+    # dates are stored as eyed3 formats them ("YYYY", "YYYY-MM", "YYYY-MM-DD"...), we only care about the year
+    for key in ("original_release_date", "release_date", "recording_date"):
+        if metadata.get(key) and metadata[key][:4].isdigit():
+            return int(metadata[key][:4])
+
+
+def scan_other_format(file_path: str, entry: CacheEntry, max_artworks: Optional[int], artworks_dir: str) -> CacheEntry:
+    # same keys eyed3 would fill, from the container headers
+    try:
+        tags = tagreaders.read(file_path, images=max_artworks != 0)
+    except Exception as e:
+        entry["error"] = type(e).__name__
+        return entry
+
+    if not tags:
+        entry["error"] = "not_loaded"
+        return entry
+
+    metadata = entry["metadata"]
+    metadata["time_secs"] = tags["time_secs"]
+    metadata["size_bytes"] = entry["size"]
+    metadata["title"] = tags["title"]
+    metadata["artist"] = tags["artist"]
+    metadata["album"] = tags["album"]
+    metadata["album_artist"] = tags["album_artist"]
+    metadata["album_type"] = None
+    metadata["genre"] = tags["genre"]
+    metadata["composer"] = tags["composer"]
+    metadata["disc_num"] = [None, None]
+    metadata["release_date"] = None
+    metadata["original_release_date"] = None
+    metadata["recording_date"] = tags["recording_date"]
+    metadata["artworks"] = [save_artwork(image, artworks_dir) for image in tags["images"][:max_artworks]]
+
+    return entry
+
+
+def scan_file(file_path: str, max_artworks: Optional[int] = None, artworks_dir=FileName.ARTWORKS_DIR) -> CacheEntry:
+    # runs in the scan processes: do not log from here. `max_artworks`: only the first n artworks are read and saved
+    # (eg. 1 for the thumbnail, 0 when only the tags are needed), None: all of them. `artworks_dir`: where they are
+    # saved, the cache's directory unless the entry is not going to be cached
+    stat = os.stat(file_path)
+    entry: CacheEntry = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, version=SCAN_VERSION, error=None, metadata=dict())
+
+    if tagreaders.reader_for(file_path):
+        # eyed3 only reads mp3 files
+        entry = scan_other_format(file_path, entry, max_artworks, artworks_dir)
+    else:
+        entry = scan_mp3(file_path, entry, max_artworks, artworks_dir)
+
+    if not entry["error"] and max_artworks is not None and len(entry["metadata"].get("artworks", [])) >= max_artworks:
+        # there might be more
+        entry["artworks_limit"] = max_artworks
+
+    return entry
+
+
+def scan_mp3(file_path: str, entry: CacheEntry, max_artworks: Optional[int], artworks_dir: str) -> CacheEntry:
+    # the frame index of id3tags first: only the headers and the artworks we need are read. Anything it doesn't
+    # handle goes through eyed3, which also decides what an error is
+    try:
+        audio_metadata = id3tags.read_mp3(file_path, functools.partial(save_artwork, artworks_dir=artworks_dir), max_artworks)
+    except Exception:
+        audio_metadata = None
+
+    if audio_metadata is not None:
+        entry["metadata"] = audio_metadata
+        return entry
+
+    # load() might return None if the mime type is not recognized
+    # http://eyed3.readthedocs.io/en/latest/eyed3.html#eyed3.core.load
+    try:
+        audio_file: Optional[Mp3AudioFile] = eyed3.load(file_path)
+    except Exception as e:
+        # UnicodeDecodeError must be investigated. Anything else shouldn't stop the whole scan
+        entry["error"] = type(e).__name__
+        return entry
+
+    if not audio_file:
+        entry["error"] = "not_loaded"
+        return entry
+
+    metadata = entry["metadata"]
+    if audio_file.info:
+        metadata["time_secs"] = audio_file.info.time_secs
+        metadata["size_bytes"] = audio_file.info.size_bytes
+
+    if audio_file.tag:
+        metadata["title"] = audio_file.tag.title
+        metadata["artist"] = audio_file.tag.artist
+        metadata["album"] = audio_file.tag.album
+        metadata["album_artist"] = audio_file.tag.album_artist
+        metadata["album_type"] = audio_file.tag.album_type
+        metadata["genre"] = audio_file.tag.genre.name if audio_file.tag.genre else None
+        metadata["composer"] = audio_file.tag.composer
+        metadata["disc_num"] = audio_file.tag.disc_num
+        metadata["release_date"] = str(audio_file.tag.release_date) if audio_file.tag.release_date else None
+        metadata["original_release_date"] = str(audio_file.tag.original_release_date) if audio_file.tag.original_release_date else None
+        metadata["recording_date"] = str(audio_file.tag.recording_date) if audio_file.tag.recording_date else None
+        metadata["artworks"] = [save_artwork(image.image_data or b"", artworks_dir) for image in list(audio_file.tag.images)[:max_artworks]]
+
+    return entry
+
+
+class MetadataCache(utilities.JournaledStorage):
+    # key: file path. An entry is valid as long as the file's size and mtime didn't change, and the artworks it needs
+    # are still in ARTWORKS_DIR. When the directory grows past `artworks_max_size` bytes, the least recently used
+    # artworks are deleted: the files using them are scanned again if they are needed
+    indent = None
+
+    def __init__(self, file_path=FileName.METADATA_CACHE, artworks_max_size=1024 * 1024 * 1024, **kwargs):
+        super().__init__(file_path, init_object={}, autosave=True, **kwargs)
+        os.makedirs(FileName.ARTWORKS_DIR, exist_ok=True)
+
+        self._artworks_max_size = artworks_max_size
+        # artworks are written by the scan processes, their size is added here when the entry using them is set
+        self._artworks = {
+            entry.name: entry.stat().st_size
+            for entry in os.scandir(FileName.ARTWORKS_DIR)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        }
+        self._artworks_size = sum(self._artworks.values())
+
+    def _apply(self, record: List):
+        key, entry = record
+        self._data[key] = entry
+
+    def get(self, file_path: Union[Path, str], max_artworks: Optional[int] = None) -> Optional[CacheEntry]:
+        entry = self._data.get(str(file_path))
+        if not entry:
+            return
+
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return
+
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return
+
+        if entry.get("version", 1) < SCAN_VERSION and tagreaders.reader_for(file_path):
+            return
+
+        limit = entry.get("artworks_limit")
+        if limit is not None and (max_artworks is None or max_artworks > limit):
+            # scanned for something that needed fewer artworks
+            return
+
+        if not all(touch_artwork(h) for h in entry["metadata"].get("artworks", [])[:max_artworks]):
+            # evicted
+            return
+
+        return entry
+
+    def set(self, file_path: Union[Path, str], entry: CacheEntry):
+        self._data[str(file_path)] = entry
+        self._log([str(file_path), entry])
+
+        for artwork_hash in entry["metadata"].get("artworks", []):
+            if artwork_hash not in self._artworks:
+                try:
+                    self._artworks[artwork_hash] = os.path.getsize(artwork_path(artwork_hash))
+                except FileNotFoundError:
+                    continue
+                self._artworks_size += self._artworks[artwork_hash]
+
+        self._evict_artworks()
+
+    def _evict_artworks(self):
+        if self._artworks_size <= self._artworks_max_size:
+            return
+
+        # only the counted ones: the others (and the ".tmp" files) have just been written by the scan processes, their
+        # entries are not set yet
+        entries = sorted(
+            (entry for entry in os.scandir(FileName.ARTWORKS_DIR) if entry.name in self._artworks),
+            key=lambda e: e.stat().st_mtime
+        )
+        for entry in entries:
+            # leave some room, so we don't scan the directory again on the next file
+            if self._artworks_size <= self._artworks_max_size * 0.9:
+                break
+
+            self._artworks_size -= self._artworks.pop(entry.name)
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def load(self, file_path: Union[Path, str], max_artworks: Optional[int] = None) -> CacheEntry:
+        # cached entry, or scan the file right now
+        entry = self.get(file_path, max_artworks)
+        if not entry:
+            entry = scan_file(str(file_path), max_artworks)
+            self.set(file_path, entry)
+
+        return entry
+
+
+def scan(paths: Iterable[Path], cache: MetadataCache, workers: Optional[int] = None, chunksize=16, max_artworks: Optional[int] = None):
+    # parse the tags of every file that is not in the cache (or changed since it was cached) using a process pool
+    stale_paths = [p for p in paths if not cache.get(p, max_artworks)]
+    if not stale_paths:
+        logger.info("metadata cache is up to date")
+        return
+
+    logger.info(f"scanning the metadata of {len(stale_paths)} files with {workers or os.cpu_count()} processes...")
+
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        entries = executor.map(functools.partial(scan_file, max_artworks=max_artworks), map(str, stale_paths), chunksize=chunksize)
+        for i, (file_path, entry) in enumerate(zip(stale_paths, entries)):
+            cache.set(file_path, entry)
+            if (i + 1) % 1000 == 0:
+                logger.info(f"scanned {i + 1}/{len(stale_paths)} files")
+
+    cache.dump()
+    logger.info("...metadata scan completed")
+
+
+class MetadataScanner:
+    # streaming counterpart of scan(): files are submitted to the process pool as soon as they are queued, so tags
+    # are parsed while the previous files are being uploaded
+    def __init__(self, cache: MetadataCache, workers: Optional[int] = None, max_artworks: Optional[int] = None):
+        self._cache = cache
+        self._max_artworks = max_artworks
+        # forkserver: the processes are started while the clients' and loguru's threads are running, a fork could copy
+        # a lock held by one of them
+        self._executor = ProcessPoolExecutor(max_workers=workers or None, mp_context=multiprocessing.get_context("forkserver"))
+        self._pending = {}
+
+    def prefetch(self, file_path: Path):
+        key = str(file_path)
+        if key in self._pending or self._cache.get(file_path, self._max_artworks):
+            return
+
+        self._pending[key] = asyncio.get_running_loop().run_in_executor(self._executor, scan_file, key, self._max_artworks)
+
+    async def load(self, file_path: Path) -> CacheEntry:
+        self.prefetch(file_path)
+
+        future = self._pending.pop(str(file_path), None)
+        if not future:
+            entry = self._cache.get(file_path, self._max_artworks)
+            if entry:
+                metrics.inc("metadata_cache_hits")
+                return entry
+
+            # changed right after prefetch() checked the cache
+            future = asyncio.get_running_loop().run_in_executor(self._executor, scan_file, str(file_path), self._max_artworks)
+
+        # only the time spent waiting for the scan process, the scan itself might have started long before
+        with metrics.span("metadata_scan_wait"):
+            entry = await future
+        self._cache.set(file_path, entry)
+
+        return entry
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
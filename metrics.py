@@ -0,0 +1,132 @@
+import json
+import time
+import asyncio
+import contextlib
+from collections import defaultdict
+from typing import Optional, Dict
+
+from loguru import logger
+
+
+PREFIX = "uploader"
+TRACE_FLUSH_INTERVAL = 1.0  # seconds
+
+
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class Registry:
+    # counters and timing spans of the upload loop. Spans are aggregated per name (count, total and max seconds) and, if
+    # a trace file is set, also written to it one json object per line
+    def __init__(self):
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.spans: Dict[str, SpanStats] = defaultdict(SpanStats)
+        self._trace = None
+        self._last_flush = 0.0
+
+    def open_trace(self, file_path: str):
+        self._trace = open(file_path, "a")
+
+    def close(self):
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    @contextlib.contextmanager
+    def span(self, name: str, **labels):
+        # works in both sync and async code: `with metrics.span("hash_file"): ...`
+        start = time.time()
+        start_counter = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start_counter
+            self.spans[name].add(duration)
+            if self._trace:
+                self._write_trace(dict(ts=start, span=name, duration=duration, error=error, **labels))
+
+    def _write_trace(self, record: dict):
+        self._trace.write(json.dumps(record, default=str) + "\n")
+
+        # buffered: a line per span, flushed at most once per TRACE_FLUSH_INTERVAL
+        now = time.monotonic()
+        if now - self._last_flush >= TRACE_FLUSH_INTERVAL:
+            self._trace.flush()
+            self._last_flush = now
+
+    def render(self) -> str:
+        # prometheus text exposition format
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.append(f"{PREFIX}_{name}_total {value}")
+
+        if self.spans:
+            lines.append(f"# TYPE {PREFIX}_span_seconds summary")
+            for name, stats in sorted(self.spans.items()):
+                lines.append(f'{PREFIX}_span_seconds_count{{span="{name}"}} {stats.count}')
+                lines.append(f'{PREFIX}_span_seconds_sum{{span="{name}"}} {stats.total:.6f}')
+
+            lines.append(f"# TYPE {PREFIX}_span_seconds_max gauge")
+            for name, stats in sorted(self.spans.items()):
+                lines.append(f'{PREFIX}_span_seconds_max{{span="{name}"}} {stats.max:.6f}')
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+inc = registry.inc
+span = registry.span
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # the headers are not needed
+        while (await reader.readline()).strip():
+            pass
+
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else ""
+        if path.split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render()
+        else:
+            status, body = "404 Not Found", "not found\n"
+
+        body = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    # GET /metrics on http://host:port. A busy port must not stop the uploads
+    try:
+        server = await asyncio.start_server(_handle_request, host, port)
+    except OSError as e:
+        logger.warning(f"unable to serve metrics on {host}:{port}: {e}")
+        return
+
+    logger.info(f"serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,125 @@
+import asyncio
+from typing import Optional, List
+
+from pyrogram import Client
+from loguru import logger
+
+import utilities as utilities
+from ratelimit import Scheduler
+
+
+class FileName:
+    PENDING_PINS = "data/pending-pins.json"
+
+
+class StoragePendingPins(utilities.Storage):
+    # messages still to pin and service messages still to delete, so they survive a restart
+    def __init__(self, file_path=FileName.PENDING_PINS):
+        super().__init__(file_path, init_object=dict(pins=[], deletes=[]))
+
+    @property
+    def pins(self) -> List[int]:
+        return self._data["pins"]
+
+    @property
+    def deletes(self) -> List[int]:
+        return self._data["deletes"]
+
+
+class DeferredPinner:
+    # pins the directory messages in the background, so uploads don't wait for the (very tight) pin rate limits.
+    # The "message pinned" service messages are deleted in bulk, with one delete_messages call per `delete_batch_size`
+    # messages or every `delete_interval` seconds
+    MAX_DELETE_BATCH = 100  # max ids per delete_messages call
+
+    def __init__(
+            self,
+            client: Client,
+            scheduler: Scheduler,
+            chat_id: int,
+            delete_batch_size=100,
+            delete_interval=60,
+            pending_file_path=FileName.PENDING_PINS
+    ):
+        self._client = client
+        self._scheduler = scheduler
+        self._chat_id = chat_id
+        self._delete_batch_size = min(delete_batch_size, self.MAX_DELETE_BATCH)
+        self._delete_interval = delete_interval
+        self._pending = StoragePendingPins(pending_file_path)
+        self._queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # messages left by the previous run are pinned first
+        for message_id in self._pending.pins:
+            self._queue.put_nowait(message_id)
+
+        if self._pending.pins or self._pending.deletes:
+            logger.info(f"{len(self._pending.pins)} pins and {len(self._pending.deletes)} deletes left by the previous run")
+
+        self._task = asyncio.create_task(self._run())
+
+    def pin(self, message_id: int):
+        self._pending.pins.append(message_id)
+        self._pending.dump()
+        self._queue.put_nowait(message_id)
+
+    async def close(self):
+        # waits for the queued pins, then deletes the remaining service messages
+        if not self._task:
+            return
+
+        logger.info(f"waiting for {self._queue.qsize()} pending pins...")
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _run(self):
+        while True:
+            try:
+                message_id = await asyncio.wait_for(self._queue.get(), timeout=self._delete_interval)
+            except asyncio.TimeoutError:
+                await self._delete_service_messages()
+                continue
+
+            if message_id is None:
+                break
+
+            await self._pin(message_id)
+            if len(self._pending.deletes) >= self._delete_batch_size:
+                await self._delete_service_messages()
+
+        await self._delete_service_messages()
+
+    async def _pin(self, message_id: int):
+        logger.info(f"pinning message {message_id}...")
+        try:
+            service_message = await self._scheduler.call(
+                "pin_chat_message",
+                self._client.pin_chat_message,
+                self._chat_id,
+                message_id,
+                disable_notification=True
+            )
+        except Exception as e:
+            # a failed pin must not stop the uploads
+            logger.opt(exception=e).error(f"an error occurred while pinning message {message_id}: {e}")
+            service_message = None
+
+        self._pending.pins.remove(message_id)
+        if service_message:
+            self._pending.deletes.append(service_message.id)
+        self._pending.dump()
+
+    async def _delete_service_messages(self):
+        while self._pending.deletes:
+            message_ids = self._pending.deletes[:self.MAX_DELETE_BATCH]
+            logger.info(f"deleting {len(message_ids)} pin service messages...")
+            try:
+                await self._scheduler.call("delete_messages", self._client.delete_messages, self._chat_id, message_ids)
+            except Exception as e:
+                logger.opt(exception=e).error(f"an error occurred while deleting service messages {message_ids}: {e}")
+                return
+
+            del self._pending.deletes[:len(message_ids)]
+            self._pending.dump()
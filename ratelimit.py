@@ -0,0 +1,165 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Callable, Awaitable
+
+from pyrogram.errors import FloodWait
+from loguru import logger
+
+import utilities as utilities
+import metrics as metrics
+
+
+class FloodWaitGate:
+    # shared by everyone calling the same method: when one of the callers hits a flood wait, everyone waits
+    def __init__(self):
+        self._resume_at = 0.0
+
+    @property
+    def remaining(self) -> float:
+        return max(0.0, self._resume_at - time.monotonic())
+
+    def trip(self, seconds: float):
+        # never shorten a flood wait another worker already received
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def wait(self):
+        # loop because another worker might extend the wait while we are sleeping
+        while self.remaining > 0:
+            await asyncio.sleep(self.remaining)
+
+
+class MethodBudget:
+    # token bucket for a single api method. The rate (calls per second) is learned: a flood wait halves it, or lowers it
+    # to what the calls made in the last WINDOW seconds would have needed to fit in the window plus the wait, if they
+    # used the whole budget. Calls that go through raise it again: quickly up to the rate in place before the flood
+    # wait, then a little at a time
+    WINDOW = 60
+    SATURATION = 0.8  # the window counts as used when it has this fraction of the calls the rate allows
+    RECOVERY_INCREASE = 0.1  # +10% per successful call, up to the rate before the last flood wait
+    INCREASE = 0.01  # +1% per successful call, past that
+
+    def __init__(self, rate: float, min_rate: float, max_rate: float):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.flood_wait = FloodWaitGate()
+        self.calls = 0  # successful calls in this run
+        self._recover_to = rate
+        self._tokens = 1.0
+        self._created = self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._calls = deque()  # timestamps of the calls made in the last WINDOW seconds
+
+    def _forget_old_calls(self, now: float):
+        while self._calls and self._calls[0] < now - self.WINDOW:
+            self._calls.popleft()
+
+    async def acquire(self):
+        # callers are served in fifo order
+        async with self._lock:
+            while True:
+                await self.flood_wait.wait()
+
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    break
+
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+            self._calls.append(now)
+            self._forget_old_calls(now)
+
+    def on_success(self):
+        self.calls += 1
+        increase = self.RECOVERY_INCREASE if self.rate < self._recover_to else self.INCREASE
+        self.rate = min(self.max_rate, self.rate * (1 + increase))
+
+    def on_flood_wait(self, seconds: int):
+        now = time.monotonic()
+        self._forget_old_calls(now)
+
+        # the budget might be younger than the window
+        observed = max(1.0, min(self.WINDOW, now - self._created))
+        if len(self._calls) >= self.SATURATION * self.rate * observed:
+            rate = min(self.rate / 2, len(self._calls) / (observed + seconds))
+        else:
+            # a window with few calls says nothing about the limit
+            rate = self.rate / 2
+
+        # one call per flood wait is what telegram asked for: never go below that (nor raise the rate)
+        self._recover_to = self.rate
+        self.rate = max(self.min_rate, rate, min(self.rate, 1 / (seconds + 1)))
+        self._tokens = 0.0
+        self.flood_wait.trip(seconds + 1)
+
+
+class Scheduler:
+    # every api call goes through here: calls are issued as fast as their method's budget allows, and a flood wait
+    # only pauses the calls of the same method. Budgets are per account, and are saved to `state_file_path` so the next
+    # run starts from what has been learned (unless `read_only`, eg. in a dry run)
+    SAVE_EVERY = 50  # calls
+    MIN_SAVED_CALLS = 20  # a rate learned from fewer calls is not saved
+
+    def __init__(
+            self,
+            state_file_path: str,
+            initial_rates: Dict[str, float],
+            default_rate=1.0,
+            min_rate=1 / 3600,
+            max_rate=30.0,
+            read_only=False
+    ):
+        self._state = utilities.StorageRateLimits(state_file_path, read_only=read_only)
+        self._read_only = read_only
+        self._initial_rates = initial_rates
+        self._default_rate = default_rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._budgets: Dict[str, MethodBudget] = {}
+        self._calls_since_save = 0
+
+    def budget(self, method: str) -> MethodBudget:
+        if method not in self._budgets:
+            rate = self._state.get(method) or self._initial_rates.get(method, self._default_rate)
+            self._budgets[method] = MethodBudget(rate, self._min_rate, self._max_rate)
+
+        return self._budgets[method]
+
+    @property
+    def flood_wait_remaining(self) -> float:
+        return max([b.flood_wait.remaining for b in self._budgets.values()], default=0.0)
+
+    def save(self):
+        if self._read_only:
+            return
+
+        self._state.update({method: budget.rate for method, budget in self._budgets.items() if budget.calls >= self.MIN_SAVED_CALLS})
+        self._calls_since_save = 0
+
+    async def call(self, method: str, func: Callable[..., Awaitable], *args, **kwargs):
+        budget = self.budget(method)
+
+        while True:
+            with metrics.span("rate_limit_wait", method=method):
+                await budget.acquire()
+
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWait as e:
+                metrics.inc("flood_waits")
+                metrics.inc("flood_wait_seconds", e.value)
+                budget.on_flood_wait(e.value)
+                logger.opt(colors=True).info(f"<r>flood_wait on {method}: will retry in {e.value} seconds</r> (budget: {budget.rate:.4f} calls/s)")
+                self.save()
+                continue
+
+            budget.on_success()
+            self._calls_since_save += 1
+            if self._calls_since_save >= self.SAVE_EVERY:
+                self.save()
+
+            return result
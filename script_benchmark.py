@@ -0,0 +1,415 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import datetime
+import resource
+import itertools
+import subprocess
+from pathlib import Path
+from typing import Optional, Union, BinaryIO
+
+import eyed3
+from PIL import Image
+import pyrogram
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+
+import utilities as utilities
+import metrics as metrics
+from config import config
+
+logger = utilities.get_logger(__file__)
+
+
+class FileName:
+    # relative to config.script_benchmark.workdir
+    TRACKS_DIR = "tracks"
+    TREE_PARAMS = "tracks/params.json"
+    DATA_DIR = "data"
+    # relative to the repository
+    RESULTS = "data/benchmark-results.jsonl"
+
+
+PART_SIZE = 512 * 1024  # same as pyrogram's save_file()
+BIG_FILE_SIZE = 10 * 1024 * 1024
+ARTWORK_SIDE = 600
+
+# mpeg 1 layer 3, 128 kbps, 44100 Hz, stereo: 417 bytes per frame, 38.28 frames per second
+MP3_FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+
+
+class FakeTelegram:
+    # local stand-in for the telegram servers: pyrogram.Client's network methods are replaced with these, so main.py can
+    # be imported and driven without a bot or a channel. Uploads share a link of `bandwidth` bytes per second, every api
+    # request takes `latency` seconds, and every `flood_wait_every` requests one fails with a FloodWait
+    def __init__(self, bandwidth: float, latency: float, flood_wait_every: int, flood_wait_seconds: int):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.flood_wait_every = flood_wait_every
+        self.flood_wait_seconds = flood_wait_seconds
+        self.requests = 0
+        self.flood_waits = 0
+        self.uploaded_bytes = 0
+        self._busy_until = 0.0
+        self._message_ids = itertools.count(1)
+
+    async def request(self, flood_wait=True):
+        # no flood waits for the uploaded parts: pyrogram's save_file() would swallow them
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if flood_wait and self.flood_wait_every and self.requests % self.flood_wait_every == 0:
+            self.flood_waits += 1
+            raise FloodWait(value=self.flood_wait_seconds)
+
+    async def transfer(self, size: int):
+        # concurrent uploads queue on the same link
+        if not self.bandwidth:
+            return
+
+        now = time.monotonic()
+        self._busy_until = max(now, self._busy_until) + size / self.bandwidth
+        await asyncio.sleep(self._busy_until - now)
+
+    def install(self):
+        backend = self
+
+        def start(client: pyrogram.Client):
+            client.me = None
+            return client
+
+        async def save_file(client: pyrogram.Client, path: Union[str, BinaryIO, None], file_id: int = None, file_part: int = 0, progress=None, progress_args=()):
+            if path is None:
+                return
+
+            # the file is really read from the disk, in parts, like pyrogram does
+            fp = open(path, "rb") if isinstance(path, (str, os.PathLike)) else path
+            try:
+                fp.seek(0, os.SEEK_END)
+                file_size = fp.tell()
+                fp.seek(file_part * PART_SIZE)
+
+                await backend.request(flood_wait=False)
+                current = file_part * PART_SIZE
+                while True:
+                    chunk = fp.read(PART_SIZE)
+                    if not chunk:
+                        break
+
+                    await backend.transfer(len(chunk))
+                    backend.uploaded_bytes += len(chunk)
+                    current += len(chunk)
+                    if progress:
+                        await progress(current, file_size, *progress_args)
+            finally:
+                if fp is not path:
+                    fp.close()
+
+            file_id = file_id or client.rnd_id()
+            parts = max(1, -(-file_size // PART_SIZE))
+            if file_size > BIG_FILE_SIZE:
+                return raw.types.InputFileBig(id=file_id, parts=parts, name="file")
+
+            return raw.types.InputFile(id=file_id, parts=parts, name="file", md5_checksum="")
+
+        async def resolve_peer(client: pyrogram.Client, peer_id):
+            return raw.types.InputPeerChannel(channel_id=1, access_hash=0)
+
+        async def invoke(client: pyrogram.Client, query, *args, **kwargs):
+            await backend.request()
+            if not isinstance(query, raw.functions.messages.SendMedia):
+                raise NotImplementedError(f"{type(query).__name__} is not simulated")
+
+            document_id = query.media.id.id if isinstance(query.media, raw.types.InputMediaDocument) else client.rnd_id()
+            message = raw.types.Message(
+                id=next(backend._message_ids),
+                peer_id=raw.types.PeerChannel(channel_id=1),
+                date=int(time.time()),
+                message=query.message,
+                entities=query.entities or [],
+                media=raw.types.MessageMediaDocument(document=raw.types.Document(
+                    id=document_id,
+                    access_hash=0,
+                    file_reference=b"",
+                    date=int(time.time()),
+                    mime_type="audio/mpeg",
+                    size=0,
+                    dc_id=2,
+                    thumbs=[],
+                    video_thumbs=[],
+                    attributes=[raw.types.DocumentAttributeAudio(duration=0)]
+                ))
+            )
+            channel = raw.types.Channel(id=1, title="benchmark", photo=raw.types.ChatPhotoEmpty(), date=0, access_hash=0, broadcast=True, restriction_reason=[])
+            return raw.types.Updates(
+                updates=[raw.types.UpdateNewChannelMessage(message=message, pts=0, pts_count=0)],
+                users=[],
+                chats=[channel],
+                date=0,
+                seq=0
+            )
+
+        async def send_message(client: pyrogram.Client, chat_id, text: str, **kwargs):
+            await backend.request()
+            return FakeMessage(client, next(backend._message_ids), text)
+
+        async def pin_chat_message(client: pyrogram.Client, chat_id, message_id: int, **kwargs):
+            await backend.request()
+            return FakeMessage(client, next(backend._message_ids), None)
+
+        async def delete_messages(client: pyrogram.Client, chat_id, message_ids, **kwargs):
+            await backend.request()
+            return len(message_ids) if isinstance(message_ids, list) else 1
+
+        pyrogram.Client.start = start
+        pyrogram.Client.save_file = save_file
+        pyrogram.Client.resolve_peer = resolve_peer
+        pyrogram.Client.invoke = invoke
+        pyrogram.Client.send_message = send_message
+        pyrogram.Client.pin_chat_message = pin_chat_message
+        pyrogram.Client.delete_messages = delete_messages
+
+
+class FakeMessage:
+    # what main.py uses of the messages returned by send_message()
+    def __init__(self, client: pyrogram.Client, message_id: int, text: Optional[str]):
+        self._client = client
+        self.id = message_id
+        self.text = text
+
+    async def pin(self, disable_notification=True):
+        return await self._client.pin_chat_message(None, self.id)
+
+    async def delete(self):
+        return await self._client.delete_messages(None, self.id)
+
+
+def make_artwork() -> bytes:
+    # noise doesn't compress: the jpeg is about as large as a real cover
+    image = Image.effect_noise((ARTWORK_SIDE, ARTWORK_SIDE), 64).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def generate_tree(tracks_path: Path, params: dict):
+    # <artist>/<album>/<nn> track.mp3: one artist and one cover per directory, unique titles so no two files have the
+    # same content hash
+    frames = MP3_FRAME * (params["file_size_mib"] * 1024 * 1024 // len(MP3_FRAME))
+    for dir_index in range(params["directories"]):
+        dir_path = tracks_path / f"Artist {dir_index:03}" / f"Album {dir_index:03}"
+        dir_path.mkdir(parents=True)
+        artwork_data = make_artwork() if params["artwork"] else None
+
+        for file_index in range(params["files_per_directory"]):
+            file_path = dir_path / f"{file_index:02} track.mp3"
+            with open(file_path, "wb") as f:
+                f.write(frames)
+
+            audio_file = eyed3.load(file_path)
+            audio_file.initTag()
+            audio_file.tag.title = f"Track {dir_index:03}-{file_index:02}"
+            audio_file.tag.artist = f"Artist {dir_index:03}"
+            audio_file.tag.album = f"Album {dir_index:03}"
+            audio_file.tag.recording_date = "2001"
+            if artwork_data:
+                audio_file.tag.images.set(eyed3.id3.frames.ImageFrame.FRONT_COVER, artwork_data, "image/jpeg", u"artwork")
+            audio_file.tag.save()
+
+        logger.info(f"generated {dir_path}")
+
+
+def prepare_workdir(workdir: Path, params: dict):
+    # the tracks are generated again only if the parameters changed, data files always start empty
+    tracks_path = workdir / FileName.TRACKS_DIR
+    params_path = workdir / FileName.TREE_PARAMS
+    try:
+        with open(params_path) as f:
+            tree_ready = json.load(f) == params
+    except FileNotFoundError:
+        tree_ready = False
+
+    if not tree_ready:
+        shutil.rmtree(tracks_path, ignore_errors=True)
+        logger.info(f"generating {params['directories'] * params['files_per_directory']} files in {tracks_path}...")
+        generate_tree(tracks_path, params)
+        with open(params_path, "w") as f:
+            json.dump(params, f)
+
+    shutil.rmtree(workdir / FileName.DATA_DIR, ignore_errors=True)
+    (workdir / FileName.DATA_DIR).mkdir()
+    (workdir / "logs").mkdir(exist_ok=True)
+    # the metadata scan processes import this script again, from the workdir
+    shutil.copy("config.toml", workdir / "config.toml")
+
+
+def storage_seconds() -> float:
+    return metrics.registry.spans["storage_dump"].total + metrics.registry.spans["storage_journal"].total
+
+
+def benchmark_storage(records: int) -> dict:
+    # journal appends of StorageList with every fsync policy, in records per second
+    result = {}
+    for policy in (utilities.FsyncPolicy.ALWAYS, utilities.FsyncPolicy.INTERVAL, utilities.FsyncPolicy.NEVER):
+        storage = utilities.StorageList(
+            f"{FileName.DATA_DIR}/storage-{policy}.json",
+            init_object=[],
+            autosave=True,
+            compact_every=config.storage.compact_every,
+            fsync=policy,
+            fsync_interval=config.storage.fsync_interval
+        )
+        start = time.perf_counter()
+        for i in range(records):
+            storage.add(Path("Artist", "Album", f"{i:06} track.mp3"))
+        result[policy] = records / (time.perf_counter() - start)
+
+    return result
+
+
+async def run_sequential(main_module):
+    # the simple path: one file after the other through process_audio_file() and send_dir_name()
+    files = utilities.walk_files(config.tracks.path, tuple(config.tracks.allowed_extensions))
+    if main_module.pinner:
+        main_module.pinner.start()
+
+    last_dir = None
+    try:
+        for file_index, file_path in enumerate(files):
+            if file_path.parent != last_dir:
+                await main_module.send_dir_name(file_path, pin=True)
+                last_dir = file_path.parent
+
+            await main_module.process_audio_file(file_path, file_index)
+    finally:
+        main_module.metadata_scanner.shutdown()
+        if main_module.pinner:
+            await main_module.pinner.close()
+
+
+def previous_result(results_path: str, params: dict) -> Optional[dict]:
+    try:
+        with open(results_path) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return
+
+    return next((r for r in reversed(results) if r["params"] == params), None)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+
+def main():
+    benchmark_config = config.script_benchmark
+    params = dict(
+        directories=benchmark_config.directories,
+        files_per_directory=benchmark_config.files_per_directory,
+        file_size_mib=benchmark_config.file_size_mib,
+        artwork=benchmark_config.artwork
+    )
+    run_params = dict(
+        **params,
+        mode=benchmark_config.mode,
+        bandwidth_mib=benchmark_config.bandwidth_mib,
+        latency_ms=benchmark_config.latency_ms,
+        flood_wait_every=benchmark_config.flood_wait_every,
+        upload_workers=config.tracks.upload_workers
+    )
+    results_path = os.path.abspath(FileName.RESULTS)
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    commit = git_commit()
+
+    workdir = Path(benchmark_config.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    prepare_workdir(workdir, params)
+    # main.py's data files and logs are relative paths
+    os.chdir(workdir)
+
+    storage_rates = benchmark_storage(benchmark_config.storage_records)
+    for policy, rate in storage_rates.items():
+        logger.info(f"storage, fsync {policy}: {rate:.0f} records/s")
+
+    backend = FakeTelegram(
+        bandwidth=benchmark_config.bandwidth_mib * 1024 * 1024,
+        latency=benchmark_config.latency_ms / 1000,
+        flood_wait_every=benchmark_config.flood_wait_every,
+        flood_wait_seconds=benchmark_config.flood_wait_seconds
+    )
+    backend.install()
+
+    # main.py reads these at import time
+    config.tracks.path = FileName.TRACKS_DIR
+    config.tracks.remove_first_n_directories_from_path = 1
+    config.tracks.remove_first_n_directories_from_path_artist = 1
+    config.tracks.resume_walk = False
+    config.tracks.default_thumbnail_path = ""
+    config.sharding.bot_tokens = []
+    # the resumable uploader talks to the media dcs directly, below what the fake backend replaces
+    config.uploads.resumable = False
+    config.metrics.serve = False
+    config.metrics.trace = False
+    if benchmark_config.rate_limit:
+        # measure the pipeline, not the budgets
+        # pins too: message_pinning_cooldown can't go below one second
+        config.rate_limits = {method: benchmark_config.rate_limit for method in [*config.rate_limits, "pin_chat_message"]}
+
+    import main as main_module
+
+    storage_seconds_before = storage_seconds()
+    start = time.perf_counter()
+    if benchmark_config.mode == "sequential":
+        main_module.app.run(run_sequential(main_module))
+    else:
+        main_module.app.run(main_module.main())
+    elapsed = time.perf_counter() - start
+
+    files_count = int(metrics.registry.counters["posted_files"])
+    run_storage_seconds = storage_seconds() - storage_seconds_before
+    result = dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        commit=commit,
+        params=run_params,
+        files=files_count,
+        seconds=round(elapsed, 3),
+        files_per_second=round(files_count / elapsed, 3),
+        mib_per_second=round(backend.uploaded_bytes / 1024 / 1024 / elapsed, 3),
+        storage_seconds=round(run_storage_seconds, 3),
+        storage_overhead=round(run_storage_seconds / elapsed, 4),
+        storage_records_per_second={policy: round(rate) for policy, rate in storage_rates.items()},
+        requests=backend.requests,
+        flood_waits=backend.flood_waits,
+        # kilobytes on linux
+        max_rss_mib=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        max_rss_children_mib=round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    )
+
+    logger.info(f"{files_count} files in {elapsed:.1f} seconds: {result['files_per_second']} files/s, {result['mib_per_second']} MiB/s")
+    logger.info(f"storage: {run_storage_seconds:.2f} seconds ({result['storage_overhead']:.1%} of the run)")
+    logger.info(f"api requests: {backend.requests} ({backend.flood_waits} flood waits)")
+    logger.info(f"max rss: {result['max_rss_mib']} MiB (scan processes: {result['max_rss_children_mib']} MiB)")
+
+    if files_count != params["directories"] * params["files_per_directory"]:
+        # not comparable with the other runs
+        logger.warning(f"only {files_count} files have been posted, see the logs in {workdir / 'logs'}")
+        sys.exit(1)
+
+    previous = previous_result(results_path, run_params)
+    if previous:
+        for key in ("files_per_second", "mib_per_second", "storage_overhead", "max_rss_mib"):
+            change = (result[key] - previous[key]) / previous[key] if previous[key] else 0
+            logger.info(f"{key}: {previous[key]} -> {result[key]} ({change:+.1%}, previous run: {previous['commit']}, {previous['date']})")
+
+    with open(results_path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, List, Tuple, Dict
+
+import eyed3
+import eyed3.id3.tag
+from eyed3.id3 import ID3_V2_2, ID3_V2_3, ID3_V2_4
+from eyed3.id3.frames import ImageFrame
+
+import utilities as utilities
+import id3tags as id3tags
+from config import config
+
+logger = utilities.get_logger(__file__)
+
+
+class Result:
+    MATCHING = "matching"  # the front cover is already this image, file not touched
+    IN_PLACE = "in_place"  # the new tag fit in the old one's padding
+    REWRITTEN = "rewritten"  # the tag grew: the whole file has been copied
+    ERROR = "error"
+
+
+# set in every worker process by init_worker(): the cover is read from the disk once and sent to the workers once
+cover = None
+skip_matching = True
+
+
+class Cover:
+    def __init__(self, data: bytes, description: str):
+        self.data = data
+        self.hash = hashlib.sha1(data).hexdigest()
+        self.mime_type = "image/png" if data.startswith(b"\x89PNG") else "image/jpeg"
+        self.description = description
+
+
+def init_worker(worker_cover: Cover, worker_skip_matching: bool, padding: int):
+    global cover, skip_matching
+    cover = worker_cover
+    skip_matching = worker_skip_matching
+
+    # eyed3 pads a rewritten tag with only 256 bytes, so changing the artwork again would rewrite the file again
+    eyed3.id3.tag.DEFAULT_PADDING = padding
+
+
+def tag_size(file_path: str) -> int:
+    # size of the id3v2 tag at the start of the file (padding included), 0 if there's none
+    with open(file_path, "rb") as f:
+        header = f.read(10)
+
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+
+    return 10 + id3tags.syncsafe(header[6:10])
+
+
+def front_cover_hashes(file_path: str) -> List[str]:
+    with id3tags.mapped(file_path) as data:
+        tag = id3tags.ID3v2Tag.parse(data) if data else None
+        if not tag:
+            return []
+
+        hashes = []
+        for i in range(tag.pictures_count):
+            if tag.picture_type(i) == ImageFrame.FRONT_COVER:
+                with tag.picture(i) as image_data:
+                    hashes.append(hashlib.sha1(image_data).hexdigest())
+
+        return hashes
+
+
+def embed(file_path: str) -> Tuple[str, Optional[str]]:
+    # runs in the worker processes: do not log from here. Returns the result and the error, if any
+    if skip_matching:
+        try:
+            if front_cover_hashes(file_path) == [cover.hash]:
+                return Result.MATCHING, None
+        except Exception:
+            # eyed3 will tell what's wrong with the file
+            pass
+
+    try:
+        audio_file = eyed3.load(file_path)
+    except Exception as e:
+        return Result.ERROR, type(e).__name__
+
+    if not audio_file:
+        return Result.ERROR, "not_loaded"
+
+    version = None
+    if not audio_file.tag:
+        audio_file.initTag(version=ID3_V2_4)
+    elif audio_file.tag.version[0] == 1:
+        # converted: id3v1 can't hold pictures
+        version = ID3_V2_4
+    elif audio_file.tag.version == ID3_V2_2:
+        # eyed3 can't write v2.2 tags
+        version = ID3_V2_3
+
+    tag = audio_file.tag
+    # images.set() only replaces the picture with the same description: drop every other front cover
+    for image in list(tag.images):
+        if image.picture_type == ImageFrame.FRONT_COVER:
+            tag.images.remove(image.description)
+    tag.images.set(ImageFrame.FRONT_COVER, cover.data, cover.mime_type, cover.description)
+
+    size_before = tag_size(file_path)
+    try:
+        tag.save(version=version)
+    except Exception as e:
+        return Result.ERROR, type(e).__name__
+
+    if size_before and tag_size(file_path) == size_before:
+        return Result.IN_PLACE, None
+
+    return Result.REWRITTEN, None
+
+
+def main():
+    script_config = config.script_embed_artwork
+    with open(script_config.artwork_path, "rb") as f:
+        embed_cover = Cover(f.read(), script_config.description)
+
+    dir_path = script_config.path or config.tracks.path
+    paths_list: List[Path] = list(utilities.walk_files(dir_path, (".mp3",)))
+    logger.info(f"embedding {script_config.artwork_path} ({embed_cover.mime_type}, {len(embed_cover.data)} bytes) in {len(paths_list)} files...")
+
+    counts: Dict[str, int] = {Result.MATCHING: 0, Result.IN_PLACE: 0, Result.REWRITTEN: 0, Result.ERROR: 0}
+    with ProcessPoolExecutor(
+        max_workers=script_config.workers or None,
+        initializer=init_worker,
+        initargs=(embed_cover, script_config.skip_matching, script_config.rewrite_padding_kib * 1024)
+    ) as executor:
+        results = executor.map(embed, map(str, paths_list), chunksize=16)
+        for i, (file_path, (result, error)) in enumerate(zip(paths_list, results)):
+            counts[result] += 1
+            if result == Result.REWRITTEN:
+                logger.info(f"full rewrite (not enough padding): {file_path}")
+            elif result == Result.ERROR:
+                logger.warning(f"{error}: {file_path}")
+
+            if (i + 1) % 1000 == 0:
+                logger.info(f"processed {i + 1}/{len(paths_list)} files")
+
+    logger.info(
+        f"...done: {counts[Result.IN_PLACE]} written in place, {counts[Result.REWRITTEN]} rewritten, "
+        f"{counts[Result.MATCHING]} already had this cover, {counts[Result.ERROR]} errors"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,103 +1,180 @@
-import io
-import os
 import asyncio
-import json
-from typing import Optional
-from typing import TypedDict
+from typing import List, Tuple, Union
 
-from pyrogram import Client
-from pyrogram.errors import FloodWait
+from pyrogram import Client, enums, types
 
 import utilities as utilities
+import history as history
+from ratelimit import Scheduler
+from pins import DeferredPinner
 from config import config
 
 logger = utilities.get_logger(__file__)
 
 
-user = Client(
-    **config.pyrogram,
-    name=config.script_fix_text_messages.name,
-    phone_number=config.script_fix_text_messages.phone_number,
-    workers=1,
-    no_updates=True
-)
-user.start()
+class FileName:
+    TEXT_MESSAGES = "data/text-messages.json"
+    CRAWL_STATE = "data/text-messages-crawl.json"
 
 
-class Storage:
-    def __init__(self, file_path, autosave=False):
-        self._file_path = os.path.normpath(file_path)
-        self._autosave = autosave
+class StorageTextMessages(utilities.JournaledStorage):
+    # local index of the channel's text messages: message id -> text
+    indent = 4
 
-        try:
-            with open(self._file_path, 'r') as f:
-                self._data = json.load(f)
-        except FileNotFoundError:
-            self._data = {}
-            self.dump()
+    def __init__(self, file_path=FileName.TEXT_MESSAGES, **kwargs):
+        super().__init__(file_path, init_object={}, autosave=True, **kwargs)
 
-    def dump(self):
-        with open(self._file_path, 'w+') as f:
-            json.dump(self._data, f, indent=4)
+    def _apply(self, record: List):
+        message_id, text = record
+        self._data[message_id] = text
 
-    def add(self, message_id: int, text: str, save=False, override_if_existing=True):
-        message_id = str(message_id)
+    def set(self, message_id: int, text: str):
+        self._data[str(message_id)] = text
+        self._log([str(message_id), text])
 
-        if message_id in self._data and not override_if_existing:
-            return False
+    def items(self) -> List[Tuple[int, str]]:
+        return [(int(message_id), text) for message_id, text in self._data.items()]
 
-        self._data[message_id] = text
 
-        if save or self._autosave:
-            self.dump()
+class StorageCrawlState(utilities.Storage, history.CrawlState):
+    # see history.CrawlState
+    def __init__(self, file_path=FileName.CRAWL_STATE):
+        super().__init__(file_path, init_object=dict(newest_id=0, oldest_id=0, complete=False, pending_newest_id=0))
 
-        return True
+    def get_state(self, key: str) -> int:
+        return self._data.get(key, 0)
 
-    def exists(self, message_id: int):
-        message_id = str(message_id)
+    def set_state(self, key: str, value: int):
+        self._data[key] = value
 
-        return message_id in self._data
+    def commit(self):
+        self.dump()
 
 
-text_messages_storage = Storage("data/text-messages.json", autosave=True)
+class ServiceMessage:
+    def __init__(self, message_id: int):
+        self.id = message_id
 
 
-async def main():
-    messages_pinning_cooldown = 90  # 90 seconds is the min time to sleep to avoid to be rate-limited
-    async for message in user.get_chat_history(config.telegram.chat_id):
-        if not message.text:
-            continue
+class DryRunClient:
+    # stands in for the user account: history comes from the local index only, changes are logged and not sent
+    name = "dry-run"
+
+    def __init__(self):
+        self._next_id = 10 ** 9
+
+    async def search_messages(self, chat_id, filter=None):
+        for _ in ():
+            yield
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        logger.info(f"[dry run] edit {message_id}: {text}")
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        logger.info(f"[dry run] pin {message_id}")
+        self._next_id += 1
+        return ServiceMessage(self._next_id)
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        logger.info(f"[dry run] delete {message_ids}")
+        return len(message_ids)
+
+    def run(self, coroutine):
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def create_client() -> Union[Client, DryRunClient]:
+    if config.script_fix_text_messages.dry_run:
+        return DryRunClient()
 
-        text_messages_storage.add(message.id, message.text)
+    user = Client(
+        **config.pyrogram,
+        name=config.script_fix_text_messages.name,
+        phone_number=config.script_fix_text_messages.phone_number,
+        workers=1,
+        no_updates=True
+    )
+    user.start()
 
-        if not message.text.startswith("/media/chemp/Volume/jungle/"):
+    return user
+
+
+client = create_client()
+
+if config.script_fix_text_messages.dry_run:
+    # nothing is sent: nothing to wait for, and nothing learned worth saving
+    scheduler = Scheduler(f"data/rate-limits-{client.name}.json", initial_rates={}, default_rate=1000, max_rate=1000, read_only=True)
+else:
+    # 90 seconds between two pins is what worked before the budgets were learned
+    scheduler = Scheduler(
+        f"data/rate-limits-{client.name}.json",
+        initial_rates={**config.rate_limits, "pin_chat_message": 1 / 90}
+    )
+
+text_messages_storage = StorageTextMessages(**config.storage)
+crawl_state = StorageCrawlState()
+
+
+def index_message(message: types.Message):
+    if message.text:
+        text_messages_storage.set(message.id, message.text)
+
+
+def plan_edits() -> List[Tuple[int, str]]:
+    # (message id, new text) of every indexed directory message still in the old format, oldest first
+    prefix = config.script_fix_text_messages.path_prefix
+    edits = []
+    for message_id, text in sorted(text_messages_storage.items()):
+        if not text.startswith(prefix):
             continue
 
-        path_str = message.text.replace("/media/chemp/Volume/jungle/", "")
-        path_list = path_str.split("/")
-        new_text = " -> ".join(path_list)
+        path_list = text.replace(prefix, "").split("/")
+        edits.append((message_id, " -> ".join(path_list)))
+
+    return edits
 
-        retry = True
-        while retry:
-            try:
-                logger.info(f"editing message {message.id} ({message.text})...")
-                await message.edit_text(new_text, disable_web_page_preview=True)
 
-                retry = False
-            except FloodWait as e:
-                logger.opt(colors=True).info(f"<r>flood_wait while editing: will retry in {e.value} seconds</r>")
-                await asyncio.sleep(e.value + 180)
+async def pinned_message_ids() -> set:
+    pinned = set()
+    async for message in client.search_messages(config.telegram.chat_id, filter=enums.MessagesFilter.PINNED):
+        pinned.add(message.id)
 
-            try:
-                logger.info(f"pinning message {message.id} and sleeping for {messages_pinning_cooldown} seconds...")
-                service_message = await message.pin(disable_notification=True)
-                await service_message.delete()
-            except FloodWait as e:
-                logger.opt(colors=True).info(f"<r>flood_wait while pinning: will retry in {e.value} seconds</r>")
-                await asyncio.sleep(e.value + 5)
+    return pinned
 
-            await asyncio.sleep(messages_pinning_cooldown + 1)
+
+async def main():
+    if config.script_fix_text_messages.dry_run:
+        logger.info(f"dry run: using the local index ({len(text_messages_storage.items())} text messages), nothing is sent")
+    else:
+        await history.crawl(client, config.telegram.chat_id, crawl_state, index_message)
+
+    edits = plan_edits()
+    pinned = await pinned_message_ids()
+    logger.info(f"{len(edits)} messages to edit, {len([i for i, _ in edits if i not in pinned])} of them to pin")
+
+    # a dry run must not leave fake pins for the next real run
+    pinner = DeferredPinner(client, scheduler, config.telegram.chat_id, pending_file_path=f"data/pending-pins-{client.name}.json")
+    pinner.start()
+    try:
+        for i, (message_id, new_text) in enumerate(edits):
+            logger.info(f"editing message {message_id} ({new_text})...")
+            await scheduler.call("edit_text", client.edit_message_text, config.telegram.chat_id, message_id, new_text, disable_web_page_preview=True)
+
+            # the pin is queued (and saved as pending) before the edit is recorded: once recorded, the message won't
+            # be planned again, so a crash in between would lose the pin
+            if message_id not in pinned:
+                pinner.pin(message_id)
+
+            # checkpoint: the edited text is in the new format, so the message won't be planned again
+            if not config.script_fix_text_messages.dry_run:
+                text_messages_storage.set(message_id, new_text)
+
+            if (i + 1) % 100 == 0:
+                logger.info(f"edited {i + 1}/{len(edits)} messages")
+    finally:
+        await pinner.close()
+        scheduler.save()
 
 
 if __name__ == '__main__':
-    user.run(main())
+    client.run(main())
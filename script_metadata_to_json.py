@@ -1,85 +1,186 @@
 import base64
+import gzip
 import io
 import json
 import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import datetime
-from typing import Optional, Union, List
+from typing import List, Iterator
 
-import eyed3
-from eyed3.mp3 import Mp3AudioFile
+try:
+    import zstandard
+except ImportError:
+    # only needed for compression = "zstd"
+    zstandard = None
 
 import utilities as utilities
+import metadata as metadata
 from config import config
 
 logger = utilities.get_logger(__file__)
 
 
+class FileName:
+    JSON_OUTPUT = "data/files-metadata.json"
+    JSONL_OUTPUT = "data/files-metadata.jsonl"
+    JSONL_CURSOR = "data/files-metadata.cursor.json"
+    SIDECAR_ARTWORKS_DIR = "data/files-metadata-artworks"
+
+
+class Compression:
+    NONE = ""
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
+EXTENSIONS = {Compression.NONE: "", Compression.GZIP: ".gz", Compression.ZSTD: ".zst"}
+
+
+class StorageExportCursor(utilities.Storage):
+    # where the jsonl export stopped: output file, its size after the last complete batch and the last file written
+    def __init__(self, file_path=FileName.JSONL_CURSOR):
+        super().__init__(file_path, init_object=dict(output=None, offset=0, last=None))
+
+    def get(self, output_file_path: str) -> dict:
+        if self._data["output"] != output_file_path or not os.path.exists(output_file_path):
+            return dict(output=output_file_path, offset=0, last=None)
+
+        return self._data
+
+    def set(self, output_file_path: str, offset: int, last: List[str]):
+        self._data = dict(output=output_file_path, offset=offset, last=last)
+        self.dump()
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    # every batch is a complete gzip member/zstd frame: concatenated, they are still a valid file, and the file can
+    # be truncated to the end of any batch
+    if compression == Compression.GZIP:
+        return gzip.compress(data)
+    elif compression == Compression.ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+
+    return data
+
+
+def build_record(file_path: Path, entry: metadata.CacheEntry, artworks: str) -> dict:
+    # artworks: "base64" (images inlined), "hashes" (only the hashes, the images have been saved in
+    # SIDECAR_ARTWORKS_DIR by the scan) or anything else (empty list)
+    audio_data = {
+        "file_path": file_path.parts[config.tracks.remove_first_n_directories_from_path:],
+        "metadata": dict()
+    }
+
+    if entry["error"] == "not_loaded":
+        logger.warning(f"loading tags returned None for file {file_path}")
+        return audio_data
+    elif entry["error"]:
+        # must investigate
+        logger.warning(f"{entry['error']} while decoding metadata for file {file_path}")
+        return audio_data
+
+    audio_metadata = dict(entry["metadata"])
+    if "artworks" in audio_metadata:
+        artwork_hashes = audio_metadata["artworks"]
+        audio_metadata["artworks"] = []
+        if artworks == "base64":
+            for artwork_hash in artwork_hashes:
+                img_bytes = metadata.read_artwork(artwork_hash) or b""
+
+                base64_encoded_result_bytes = base64.b64encode(img_bytes)
+                base64_encoded_result_str = base64_encoded_result_bytes.decode('ascii')
+                audio_metadata["artworks"].append(base64_encoded_result_str)
+        elif artworks == "hashes":
+            audio_metadata["artworks"] = artwork_hashes
+
+    audio_data["metadata"] = audio_metadata
+    return audio_data
+
+
+def batches(paths: Iterator[Path], batch_size: int) -> Iterator[List[Path]]:
+    batch = []
+    for file_path in paths:
+        batch.append(file_path)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def log_ignored_file(file_path: Path):
+    logger.opt(colors=True).info(f"<y>file ignored: invalid extension</y>: {file_path.parent} -> {file_path.name}")
+
+
+def export_json(metadata_cache: metadata.MetadataCache, allowed_extensions: tuple):
+    # everything is kept in memory and written at the end
+    paths_list: List[Path] = list(utilities.walk_files(config.tracks.path, allowed_extensions, on_ignored=log_ignored_file))
+    artworks = "base64" if config.script_metadata_to_json.include_base64_artwork_string else None
+    max_artworks = None if artworks else 0
+    metadata.scan(paths_list, metadata_cache, config.metadata.scan_workers, max_artworks=max_artworks)
+
+    data = [build_record(file_path, metadata_cache.load(file_path, max_artworks), artworks) for file_path in paths_list]
+
+    with open(FileName.JSON_OUTPUT, "w+") as f:
+        json.dump(data, f, indent=2)
+
+
+def export_jsonl(allowed_extensions: tuple):
+    # one line per file, written one batch at a time, and a run that stops halfway is resumed from the last complete
+    # batch. The scan results go straight to the output, not through the metadata cache (which keeps every entry in
+    # memory): memory usage doesn't depend on the library size
+    compression = config.script_metadata_to_json.compression
+    if compression == Compression.ZSTD and not zstandard:
+        logger.error("zstd compression needs the zstandard package: pip install zstandard")
+        return
+
+    output_file_path = FileName.JSONL_OUTPUT + EXTENSIONS[compression]
+    cursor_storage = StorageExportCursor()
+    cursor = cursor_storage.get(output_file_path)
+    if cursor["last"]:
+        logger.info(f"resuming {output_file_path} after {cursor['last']} (delete {FileName.JSONL_CURSOR} to start over)")
+
+    artworks = "hashes" if config.script_metadata_to_json.include_artworks else None
+    max_artworks = None if artworks else 0
+    if artworks:
+        os.makedirs(FileName.SIDECAR_ARTWORKS_DIR, exist_ok=True)
+
+    paths = utilities.walk_files(config.tracks.path, allowed_extensions, start_after=cursor["last"], on_ignored=log_ignored_file)
+    # the artworks go straight to the export's directory, once per content: the metadata cache's one is bounded by its
+    # evictions, and nothing would evict them
+    scan_file = functools.partial(metadata.scan_file, max_artworks=max_artworks, artworks_dir=FileName.SIDECAR_ARTWORKS_DIR)
+    written = 0
+    with ProcessPoolExecutor(max_workers=config.metadata.scan_workers or None) as executor, open(output_file_path, "ab") as f:
+        # drop whatever was written after the last complete batch
+        f.truncate(cursor["offset"])
+
+        for batch in batches(paths, config.script_metadata_to_json.batch_size):
+            lines = io.StringIO()
+            for file_path, entry in zip(batch, executor.map(scan_file, map(str, batch), chunksize=16)):
+                lines.write(json.dumps(build_record(file_path, entry, artworks)) + "\n")
+
+            f.write(compress(lines.getvalue().encode(), compression))
+            f.flush()
+            os.fsync(f.fileno())
+            cursor_storage.set(output_file_path, f.tell(), utilities.relative_parts(batch[-1], config.tracks.path))
+
+            written += len(batch)
+            logger.info(f"written {written} files")
+
+    logger.info(f"...export completed: {output_file_path}")
+
+
 def main():
-    tracks_path = Path(config.tracks.path)
     allowed_extensions = tuple(config.tracks.allowed_extensions)
     logger.info(f"allowed extensions: {allowed_extensions}")
-    data = []
-    for file_path in tracks_path.rglob("*"):
-        if file_path.is_dir():
-            continue
-
-        if not file_path.name.lower().endswith(allowed_extensions):
-            logger.opt(colors=True).info(f"<y>file ignored: invalid extension</y>: {file_path.parent} -> {file_path.name}")
-            continue
-
-        audio_data = {
-            "file_path": file_path.parts[config.tracks.remove_first_n_directories_from_path:],
-            "metadata": dict()
-        }
-
-        try:
-            audio_file: Optional[Mp3AudioFile] = eyed3.load(file_path)
-        except UnicodeDecodeError:
-            # must investigate
-            logger.warning(f"UnicodeDecodeError while decoding metadata for file {file_path}")
-            data.append(audio_data)
-            continue
-
-        if not audio_file:
-            logger.warning(f"loading tags returned None for file {file_path}")
-            data.append(audio_data)
-            continue
-
-        metadata = dict()
-        if audio_file.info:
-            metadata["time_secs"] = audio_file.info.time_secs
-            metadata["size_bytes"] = audio_file.info.size_bytes
-
-        if audio_file.tag:
-            metadata["title"] = audio_file.tag.title
-            metadata["artist"] = audio_file.tag.artist
-            metadata["album"] = audio_file.tag.album
-            metadata["album_artist"] = audio_file.tag.album_artist
-            metadata["album_type"] = audio_file.tag.album_type
-            metadata["genre"] = audio_file.tag.genre.name if audio_file.tag.genre else None
-            metadata["composer"] = audio_file.tag.composer
-            metadata["disc_num"] = audio_file.tag.disc_num
-            metadata["release_date"] = str(audio_file.tag.release_date) if audio_file.tag.release_date else None
-            metadata["original_release_date"] = str(audio_file.tag.original_release_date) if audio_file.tag.original_release_date else None
-            metadata["recording_date"] = str(audio_file.tag.recording_date) if audio_file.tag.recording_date else None
-
-            metadata["artworks"] = []
-            if config.script_metadata_to_json.include_base64_artwork_string and audio_file.tag.images:
-                for image in audio_file.tag.images:
-                    artwork_mem = io.BytesIO(image.image_data)
-                    artwork_mem.seek(0)
-                    img_bytes = artwork_mem.read()
-
-                    base64_encoded_result_bytes = base64.b64encode(img_bytes)
-                    base64_encoded_result_str = base64_encoded_result_bytes.decode('ascii')
-                    metadata["artworks"].append(base64_encoded_result_str)
-
-        audio_data["metadata"] = metadata
-        data.append(audio_data)
-
-    with open("data/files-metadata.json", "w+") as f:
-        json.dump(data, f, indent=2)
+
+    if config.script_metadata_to_json.format == "jsonl":
+        export_jsonl(allowed_extensions)
+    else:
+        metadata_cache = metadata.MetadataCache(artworks_max_size=config.metadata.artworks_max_size_mib * 1024 * 1024, **config.storage)
+        export_json(metadata_cache, allowed_extensions)
 
 
 if __name__ == '__main__':
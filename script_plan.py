@@ -0,0 +1,219 @@
+import os
+import glob
+import json
+import datetime
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, List, Dict
+
+import utilities as utilities
+import metadata as metadata
+import uploads as uploads
+from config import config
+
+logger = utilities.get_logger(__file__)
+
+
+class FileName:
+    PLAN = "data/upload-plan.json"
+    TRACES = "logs/trace_*.jsonl"
+    # same files used by main.py
+    PROCESSED_TRACKS = "data/processed-tracks.json"
+    WALK_CURSOR = "data/walk-cursor.json"
+
+
+class DirPlan:
+    def __init__(self):
+        self.file_paths: List[Path] = []  # to upload
+        self.size = 0
+        self.header = False  # the directory name message is posted (and pinned) before the first track
+        self.oversize: List[str] = []
+        self.unreadable: List[str] = []
+        self.tag_errors: List[str] = []  # uploaded anyway, without tags
+        self.seconds = 0.0
+
+    def to_dict(self, dir_path: Path, starts_after: float) -> dict:
+        return dict(
+            directory=str(dir_path),
+            files=len(self.file_paths),
+            size_bytes=self.size,
+            header=self.header,
+            oversize=self.oversize,
+            unreadable=self.unreadable,
+            tag_errors=self.tag_errors,
+            estimated_seconds=round(self.seconds),
+            starts_after_seconds=round(starts_after)
+        )
+
+
+def measured_bandwidth(trace_paths: List[str]) -> Optional[float]:
+    # bytes per second, from the upload spans of the previous runs' traces. Spans of concurrent uploads overlap: the
+    # bytes are divided by the time at least one upload was running, so the result is what all the workers (and bots)
+    # upload together
+    intervals = []
+    total_size = 0
+    for trace_path in trace_paths:
+        with open(trace_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a run that has been killed
+                    continue
+
+                if record.get("span") == "upload" and not record.get("error") and record.get("size"):
+                    intervals.append((record["ts"], record["ts"] + record["duration"]))
+                    total_size += record["size"]
+
+    busy_seconds = 0.0
+    busy_until = 0.0
+    for start, end in sorted(intervals):
+        busy_seconds += max(0.0, end - max(start, busy_until))
+        busy_until = max(busy_until, end)
+
+    return total_size / busy_seconds if busy_seconds else None
+
+
+def plan_files(processed: utilities.StorageList) -> Dict[Path, DirPlan]:
+    # the same walk main.py does: files already processed are skipped, a directory name message is posted every time
+    # the directory changes, too big files are skipped without affecting that
+    start_after = None
+    if config.tracks.resume_walk:
+        start_after = utilities.StorageWalkCursor(FileName.WALK_CURSOR, config.tracks.path, read_only=True).get()
+        if start_after:
+            logger.info(f"resuming after {start_after}, like main.py will")
+
+    dirs: Dict[Path, DirPlan] = {}
+    last_dir_path = None
+    for file_path in utilities.walk_files(config.tracks.path, tuple(config.tracks.allowed_extensions), start_after=start_after):
+        if processed.exists(file_path):
+            continue
+
+        dir_plan = dirs.setdefault(file_path.parent, DirPlan())
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError as e:
+            dir_plan.unreadable.append(f"{file_path.name} ({type(e).__name__})")
+            continue
+
+        if file_size > uploads.FILE_SIZE_LIMIT_MIB * 1024 * 1024:
+            dir_plan.oversize.append(file_path.name)
+            continue
+
+        if not os.access(file_path, os.R_OK):
+            # main.py would stop when opening it
+            dir_plan.unreadable.append(f"{file_path.name} (PermissionError)")
+            continue
+
+        if not file_size:
+            # pyrogram refuses to upload it
+            dir_plan.unreadable.append(f"{file_path.name} (empty)")
+            continue
+
+        if file_path.parent != last_dir_path:
+            dir_plan.header = True
+            last_dir_path = file_path.parent
+
+        dir_plan.file_paths.append(file_path)
+        dir_plan.size += file_size
+
+    return dirs
+
+
+def check_tags(dirs: Dict[Path, DirPlan]):
+    # the metadata cache is read-only, main.py may be running: the files missing from it are parsed (without the
+    # artworks) but not added to it
+    metadata_cache = metadata.MetadataCache(read_only=True, **config.storage)
+    file_paths = [file_path for dir_plan in dirs.values() for file_path in dir_plan.file_paths]
+    entries = {file_path: metadata_cache.get(file_path, max_artworks=0) for file_path in file_paths}
+
+    stale_paths = [file_path for file_path, entry in entries.items() if not entry]
+    if stale_paths:
+        logger.info(f"reading the tags of {len(stale_paths)} files missing from the metadata cache...")
+        with ProcessPoolExecutor(max_workers=config.metadata.scan_workers or None) as executor:
+            scan_file = functools.partial(metadata.scan_file, max_artworks=0)
+            entries.update(zip(stale_paths, executor.map(scan_file, map(str, stale_paths), chunksize=16)))
+
+    for file_path, entry in entries.items():
+        if entry["error"]:
+            dirs[file_path.parent].tag_errors.append(f"{file_path.name} ({entry['error']})")
+
+
+def call_rate(rate_limits: utilities.StorageRateLimits, method: str, initial_rate: float) -> float:
+    # calls per second: what the bot learned in the previous runs, or what main.py starts from
+    return rate_limits.get(method) or initial_rate
+
+
+def main():
+    # read-only: main.py may be running
+    processed = utilities.StorageList(FileName.PROCESSED_TRACKS, init_object=[], read_only=True, **config.storage)
+
+    logger.info(f"walking {config.tracks.path}...")
+    dirs = plan_files(processed)
+    if config.script_plan.read_tags:
+        check_tags(dirs)
+
+    bandwidth = config.script_plan.bandwidth_mib * 1024 * 1024
+    if bandwidth:
+        logger.info(f"bandwidth: {config.script_plan.bandwidth_mib} MiB/s (configured)")
+    else:
+        trace_paths = sorted(glob.glob(FileName.TRACES))
+        bandwidth = measured_bandwidth(trace_paths)
+        if bandwidth:
+            logger.info(f"bandwidth: {bandwidth / 1024 / 1024:.2f} MiB/s (measured from {len(trace_paths)} traces)")
+        else:
+            logger.warning("no bandwidth to estimate the upload time: set [script_plan] bandwidth_mib, or run main.py with [metrics] trace = true")
+
+    rate_limits = utilities.StorageRateLimits(f"data/rate-limits-{config.bot_account.name}.json", read_only=True)
+    send_audio_rate = call_rate(rate_limits, "send_audio", config.rate_limits.send_audio)
+    send_message_rate = call_rate(rate_limits, "send_message", config.rate_limits.send_message)
+    pin_rate = call_rate(rate_limits, "pin_chat_message", config.rate_limits.get("pin_chat_message") or 1 / max(1, config.tracks.message_pinning_cooldown))
+    logger.info(f"one pin every {1 / pin_rate:.1f} seconds{' (in the background)' if config.tracks.defer_pins else ''}")
+
+    # uploads and posts overlap, the slowest of the two sets the pace. Pins make the uploads wait, unless deferred
+    total_seconds = 0.0
+    plan = []
+    for dir_path, dir_plan in dirs.items():
+        transfer_seconds = dir_plan.size / bandwidth if bandwidth else 0.0
+        post_seconds = len(dir_plan.file_paths) / send_audio_rate + dir_plan.header / send_message_rate
+        dir_plan.seconds = max(transfer_seconds, post_seconds)
+        if not config.tracks.defer_pins:
+            dir_plan.seconds += dir_plan.header / pin_rate
+
+        plan.append(dir_plan.to_dict(dir_path, total_seconds))
+        total_seconds += dir_plan.seconds
+
+        if dir_plan.file_paths:
+            logger.info(
+                f"{dir_path}: {len(dir_plan.file_paths)} files, {utilities.human_readable_size(dir_plan.size)}, "
+                f"~{datetime.timedelta(seconds=round(dir_plan.seconds))} (starts after {datetime.timedelta(seconds=round(total_seconds - dir_plan.seconds))})"
+            )
+        for name in dir_plan.oversize:
+            logger.warning(f"too big, will be skipped: {dir_path} -> {name}")
+        for name in dir_plan.unreadable:
+            logger.warning(f"unreadable, the run would stop here: {dir_path} -> {name}")
+        for name in dir_plan.tag_errors:
+            logger.info(f"tags can't be read: {dir_path} -> {name}")
+
+    headers = sum(d.header for d in dirs.values())
+    if config.tracks.defer_pins:
+        # the run waits for the pending pins before exiting
+        total_seconds = max(total_seconds, headers / pin_rate)
+
+    with open(FileName.PLAN, "w+") as f:
+        json.dump(plan, f, indent=2)
+
+    logger.info(
+        f"{sum(len(d.file_paths) for d in dirs.values())} files to upload ({utilities.human_readable_size(sum(d.size for d in dirs.values()))}) "
+        f"in {headers} directories, {headers} pins"
+    )
+    logger.info(
+        f"{sum(len(d.oversize) for d in dirs.values())} too big, {sum(len(d.unreadable) for d in dirs.values())} unreadable, "
+        f"{sum(len(d.tag_errors) for d in dirs.values())} with unreadable tags"
+    )
+    logger.info(f"estimated time: {datetime.timedelta(seconds=round(total_seconds))}{'' if bandwidth else ' (posts and pins only)'}, see {FileName.PLAN}")
+
+
+if __name__ == '__main__':
+    main()
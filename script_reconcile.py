@@ -0,0 +1,160 @@
+import asyncio
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from pyrogram import Client, types
+
+import utilities as utilities
+import history as history
+from config import config
+
+logger = utilities.get_logger(__file__)
+
+
+class FileName:
+    CHANNEL_MIRROR = "data/channel.sqlite3"
+    # same files used by main.py
+    PROCESSED_TRACKS = "data/processed-tracks.json"
+    POSTED_MESSAGES = "data/posted-messages.json"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS audio_messages (
+    message_id INTEGER PRIMARY KEY,
+    file_name TEXT,
+    file_size INTEGER,
+    duration INTEGER,
+    performer TEXT,
+    title TEXT
+);
+CREATE INDEX IF NOT EXISTS audio_messages_file ON audio_messages (file_name, file_size);
+CREATE TABLE IF NOT EXISTS crawl_state (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+
+class ChannelMirror(history.CrawlState):
+    # local copy of the channel's audio messages, and where the crawl of the history stopped
+    def __init__(self, file_path=FileName.CHANNEL_MIRROR):
+        self._db = sqlite3.connect(file_path)
+        self._db.executescript(SCHEMA)
+
+    def get_state(self, key: str) -> int:
+        row = self._db.execute("SELECT value FROM crawl_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def set_state(self, key: str, value: int):
+        self._db.execute("INSERT OR REPLACE INTO crawl_state (key, value) VALUES (?, ?)", (key, value))
+
+    def add(self, message_id: int, file_name: str, file_size: int, duration: int, performer: str, title: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO audio_messages VALUES (?, ?, ?, ?, ?, ?)",
+            (message_id, file_name, file_size, duration, performer, title)
+        )
+
+    def commit(self):
+        self._db.commit()
+
+    def messages_by_file(self) -> Dict[Tuple[str, int], List[int]]:
+        # (file name, size) -> message ids, oldest first
+        result = defaultdict(list)
+        for message_id, file_name, file_size in self._db.execute("SELECT message_id, file_name, file_size FROM audio_messages ORDER BY message_id"):
+            result[(file_name, file_size)].append(message_id)
+
+        return result
+
+    def count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM audio_messages").fetchone()[0]
+
+
+def index_message(mirror: ChannelMirror, message: types.Message):
+    media = message.audio or message.document
+    if media:
+        mirror.add(
+            message.id,
+            media.file_name,
+            media.file_size,
+            getattr(media, "duration", None),
+            getattr(media, "performer", None),
+            getattr(media, "title", None)
+        )
+
+
+def reconcile(mirror: ChannelMirror):
+    # files are matched to the audio messages by name and size. The messages already recorded for a track and the
+    # processed files are set aside first, then the remaining files are paired with the remaining messages in walk
+    # order (eg. the same track in two directories)
+    # only a report: main.py's files are not touched, not even to fix a partial journal line
+    read_only = not config.script_reconcile.apply
+    processed = utilities.StorageList(FileName.PROCESSED_TRACKS, init_object=[], read_only=read_only, **config.storage)
+    posted_messages = utilities.StoragMessages(FileName.POSTED_MESSAGES, read_only=read_only, **config.storage)
+    message_ids_by_path = posted_messages.audio_message_ids()
+
+    files_by_key: Dict[Tuple[str, int], List[Path]] = defaultdict(list)
+    for file_path in utilities.walk_files(config.tracks.path, tuple(config.tracks.allowed_extensions)):
+        files_by_key[(file_path.name, file_path.stat().st_size)].append(file_path)
+
+    messages_by_key = mirror.messages_by_file()
+    posted_not_processed = []
+    processed_not_posted = []
+    for key, file_paths in files_by_key.items():
+        message_ids = messages_by_key.get(key, [])
+        free_message_ids = [message_id for message_id in message_ids if not posted_messages.exists(message_id)]
+        for file_path in file_paths:
+            if not processed.exists(file_path) or message_ids_by_path.get(file_path.parts) in message_ids:
+                continue
+
+            # processed, but its message was not recorded (or is gone): it takes one of the free ones
+            if free_message_ids:
+                free_message_ids.pop(0)
+            else:
+                processed_not_posted.append(file_path)
+
+        not_processed = [file_path for file_path in file_paths if not processed.exists(file_path)]
+        posted_not_processed.extend(zip(not_processed, free_message_ids))
+
+    logger.info(f"{mirror.count()} audio messages in the channel, {sum(len(p) for p in files_by_key.values())} files on disk")
+    logger.info(f"{len(posted_not_processed)} files are in the channel but not in {FileName.PROCESSED_TRACKS}")
+    for file_path in processed_not_posted:
+        logger.warning(f"marked as processed, but not found in the channel: {file_path}")
+
+    if not config.script_reconcile.apply:
+        for file_path, message_id in posted_not_processed:
+            logger.info(f"would add {file_path} (message {message_id})")
+        logger.info("nothing changed, set 'apply = true' to update the storage files")
+        return
+
+    for file_path, message_id in posted_not_processed:
+        processed.add(file_path)
+        # older than the messages posted since: last() goes by message id, so needs_dir_name() is not affected
+        posted_messages.add(message_id, file_path, override_if_existing=False)
+
+    # one dump per file instead of one journal record per track
+    processed.dump()
+    posted_messages.dump()
+    logger.info(f"added {len(posted_not_processed)} files to {FileName.PROCESSED_TRACKS} and {FileName.POSTED_MESSAGES}")
+
+
+async def main():
+    mirror = ChannelMirror()
+
+    if config.script_reconcile.crawl:
+        user = Client(
+            **config.pyrogram,
+            name=config.script_reconcile.name,
+            phone_number=config.script_reconcile.phone_number,
+            workers=1,
+            no_updates=True
+        )
+        async with user:
+            await history.crawl(user, config.telegram.chat_id, mirror, lambda message: index_message(mirror, message))
+
+    reconcile(mirror)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,9 +1,12 @@
 import math
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-
-import eyed3
+from typing import List, Dict, Optional
 
 import utilities as utilities
+import metadata as metadata
+import audioinfo as audioinfo
 from config import config
 
 logger = utilities.get_logger(__file__)
@@ -14,59 +17,96 @@ HOUR_SECONDS = 3600
 MINUTE_SECONDS = 60
 
 
+class DirTotal:
+    def __init__(self):
+        self.duration = 0.0
+        self.with_duration = 0
+        self.without_duration = 0
+
+
+def format_duration(total_duration: float) -> str:
+    days = total_duration // DAY_SECONDS
+    total_duration = total_duration % DAY_SECONDS
+
+    hours = total_duration // HOUR_SECONDS
+    total_duration %= HOUR_SECONDS
+
+    minutes = total_duration // MINUTE_SECONDS
+    total_duration %= MINUTE_SECONDS
+
+    seconds = int(total_duration)
+
+    return f"{days} days, {hours} hours, {minutes} minutes, {seconds} seconds"
+
+
+def durations_from_tags(paths_list: List[Path]) -> List[Optional[float]]:
+    # full tag parse of every file (cached, artworks are skipped), can take a while on large libraries
+    metadata_cache = metadata.MetadataCache(artworks_max_size=config.metadata.artworks_max_size_mib * 1024 * 1024, **config.storage)
+    metadata.scan(paths_list, metadata_cache, config.metadata.scan_workers, max_artworks=0)
+
+    durations = []
+    for file_path in paths_list:
+        entry = metadata_cache.load(file_path, max_artworks=0)
+
+        if entry["error"] == "not_loaded":
+            logger.warning(f"couldn't load file: {file_path}")
+            durations.append(None)
+        elif entry["error"]:
+            logger.warning(f"{entry['error']}: {file_path}")
+            durations.append(None)
+        else:
+            durations.append(entry["metadata"].get("time_secs"))
+
+    return durations
+
+
+def durations_from_headers(paths_list: List[Path]) -> List[Optional[float]]:
+    # only the first frame of every file is read, see audioinfo.mp3_duration()
+    logger.info(f"reading the headers of {len(paths_list)} files with {config.metadata.scan_workers or 'one per cpu'} processes...")
+    with ProcessPoolExecutor(max_workers=config.metadata.scan_workers or None) as executor:
+        return list(executor.map(audioinfo.duration, paths_list, chunksize=64))
+
+
 def main():
     allowed_extensions = tuple(config.tracks.allowed_extensions)
     logger.info(f"allowed extensions: {allowed_extensions}")
 
-    tracks_path = Path(config.tracks.path)
-    total_duration = 0
-    tracks_count_with_duration = 0
-    tracks_count_without_duration = 0
-    for file_path in tracks_path.rglob("*"):
-        if file_path.is_dir():
-            continue
+    def log_ignored_file(file_path: Path):
+        logger.opt(colors=True).info(f"<y>not an mp3</y>: {file_path.parent} -> {file_path.name}")
 
-        if not file_path.name.lower().endswith(allowed_extensions):
-            logger.opt(colors=True).info(f"<y>not an mp3</y>: {file_path.parent} -> {file_path.name}")
-            continue
+    paths_list: List[Path] = list(utilities.walk_files(config.tracks.path, allowed_extensions, on_ignored=log_ignored_file))
 
-        try:
-            audio_file = eyed3.load(file_path)
-        except UnicodeDecodeError:
-            logger.warning(f"UnicodeDecodeError: {file_path}")
-            tracks_count_without_duration += 1
-            continue
+    if config.script_total_time.mode == "headers":
+        durations = durations_from_headers(paths_list)
+    else:
+        durations = durations_from_tags(paths_list)
 
-        if not audio_file:
-            logger.warning(f"couldn't load file: {file_path}")
-            tracks_count_without_duration += 1
-            continue
-        elif not audio_file.info or not audio_file.info.time_secs:
-            logger.warning(f"couldn't read file duration: {file_path}")
-            tracks_count_without_duration += 1
+    dir_totals: Dict[Path, DirTotal] = defaultdict(DirTotal)
+    for file_path, duration in zip(paths_list, durations):
+        dir_total = dir_totals[file_path.parent]
+        if not duration:
+            logger.debug(f"couldn't read file duration: {file_path}")
+            dir_total.without_duration += 1
             continue
 
-        total_duration += audio_file.info.time_secs
-        tracks_count_with_duration += 1
+        dir_total.duration += duration
+        dir_total.with_duration += 1
+
+    total_duration = sum(t.duration for t in dir_totals.values())
+    tracks_count_with_duration = sum(t.with_duration for t in dir_totals.values())
+    tracks_count_without_duration = sum(t.without_duration for t in dir_totals.values())
 
     # calculate the average duration and sum it to the total for every track that doesn't have a duration
-    average_duration = total_duration / tracks_count_with_duration
+    average_duration = total_duration / tracks_count_with_duration if tracks_count_with_duration else 0
+    for dir_path, dir_total in dir_totals.items():
+        dir_total.duration += average_duration * dir_total.without_duration
+        without_duration = f" ({dir_total.without_duration} without duration)" if dir_total.without_duration else ""
+        logger.info(f"{dir_path}: {dir_total.with_duration + dir_total.without_duration} tracks{without_duration}, {format_duration(dir_total.duration)}")
+
     total_duration += average_duration * tracks_count_without_duration
 
     logger.info(f"{tracks_count_with_duration} tracks + {tracks_count_without_duration} without duration, tot {total_duration} seconds")
-
-    days = total_duration // DAY_SECONDS
-    total_duration = total_duration % DAY_SECONDS
-
-    hours = total_duration // HOUR_SECONDS
-    total_duration %= HOUR_SECONDS
-
-    minutes = total_duration // MINUTE_SECONDS
-    total_duration %= MINUTE_SECONDS
-
-    seconds = int(total_duration)
-
-    logger.info(f"{days} days, {hours} hours, {minutes} minutes, {seconds} seconds")
+    logger.info(format_duration(total_duration))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,365 @@
+import base64
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Optional, Union, List, Dict, Callable, BinaryIO
+from typing import TypedDict
+
+
+# header-only readers for the formats eyed3 doesn't support. They read the tags and the duration from the container
+# headers, the audio is never decoded (and, for most formats, never read)
+
+
+class Tags(TypedDict):
+    time_secs: Optional[float]
+    title: Optional[str]
+    artist: Optional[str]
+    album: Optional[str]
+    album_artist: Optional[str]
+    genre: Optional[str]
+    composer: Optional[str]
+    recording_date: Optional[str]
+    images: List[bytes]  # front cover first, when the format tells
+
+
+def empty_tags() -> Tags:
+    return dict(time_secs=None, title=None, artist=None, album=None, album_artist=None, genre=None, composer=None, recording_date=None, images=[])
+
+
+# MP4 (m4a): https://developer.apple.com/documentation/quicktime-file-format
+
+
+MP4_CONTAINERS = (b"moov", b"udta", b"meta", b"ilst", b"trak", b"mdia")
+MP4_ITEMS = {
+    b"\xa9nam": "title",
+    b"\xa9ART": "artist",
+    b"\xa9alb": "album",
+    b"aART": "album_artist",
+    b"\xa9gen": "genre",
+    b"\xa9wrt": "composer",
+    b"\xa9day": "recording_date",
+}
+
+
+def mp4_atoms(f: BinaryIO, start: int, end: int):
+    # (type, payload offset, payload size) of the atoms between start and end. Payloads are not read: `mdat` can be
+    # gigabytes long
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, atom_type = struct.unpack(">I4s", f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+
+        if size < header_size:
+            return
+
+        yield atom_type, offset + header_size, size - header_size
+        offset += size
+
+
+def read_mp4(f: BinaryIO, file_size: int, images=True) -> Optional[Tags]:
+    f.seek(4)
+    if f.read(4) != b"ftyp":
+        return
+
+    tags = empty_tags()
+
+    def walk(start: int, end: int):
+        for atom_type, offset, size in mp4_atoms(f, start, end):
+            if atom_type == b"mvhd":
+                f.seek(offset)
+                version = f.read(1)[0]
+                if version == 1:
+                    f.seek(offset + 20)
+                    timescale, duration = struct.unpack(">IQ", f.read(12))
+                else:
+                    f.seek(offset + 12)
+                    timescale, duration = struct.unpack(">II", f.read(8))
+                tags["time_secs"] = duration / timescale if timescale else None
+            elif atom_type == b"meta":
+                # full atom: version and flags come before the children
+                walk(offset + 4, offset + size)
+            elif atom_type in MP4_CONTAINERS:
+                walk(offset, offset + size)
+            elif atom_type in MP4_ITEMS or atom_type == b"covr":
+                for data_type, data_offset, data_size in mp4_atoms(f, offset, offset + size):
+                    if data_type != b"data" or data_size < 8:
+                        continue
+
+                    # 4 bytes type, 4 bytes locale, then the value
+                    if atom_type == b"covr":
+                        if images:
+                            f.seek(data_offset + 8)
+                            tags["images"].append(f.read(data_size - 8))
+                    else:
+                        f.seek(data_offset + 8)
+                        tags[MP4_ITEMS[atom_type]] = f.read(data_size - 8).decode("utf-8", errors="replace")
+
+    walk(0, file_size)
+    return tags
+
+
+# RIFF/WAV: http://www-mmsp.ece.mcgill.ca/Documents/AudioFormats/WAVE/WAVE.html
+
+
+RIFF_INFO = {b"INAM": "title", b"IART": "artist", b"IPRD": "album", b"IGNR": "genre", b"ICRD": "recording_date"}
+
+
+def read_wav(f: BinaryIO, file_size: int, images=True) -> Optional[Tags]:
+    riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+    if riff != b"RIFF" or wave != b"WAVE":
+        return
+
+    tags = empty_tags()
+    byte_rate = None
+    offset = 12
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        chunk_id, chunk_size = struct.unpack("<4sI", f.read(8))
+        if chunk_id == b"fmt ":
+            byte_rate = struct.unpack("<HHII", f.read(12))[3]
+        elif chunk_id == b"data" and byte_rate:
+            # the data chunk size might be wrong (0 or 0xffffffff) if the file was written by a stream
+            data_size = min(chunk_size, file_size - offset - 8)
+            tags["time_secs"] = data_size / byte_rate
+        elif chunk_id == b"LIST" and f.read(4) == b"INFO":
+            info = f.read(chunk_size - 4)
+            info_offset = 0
+            while info_offset + 8 <= len(info):
+                info_id, info_size = struct.unpack("<4sI", info[info_offset:info_offset + 8])
+                if info_id in RIFF_INFO:
+                    value = info[info_offset + 8:info_offset + 8 + info_size].rstrip(b"\0")
+                    tags[RIFF_INFO[info_id]] = value.decode("latin-1")
+                info_offset += 8 + info_size + info_size % 2
+
+        # chunks are padded to an even size
+        offset += 8 + chunk_size + chunk_size % 2
+
+    return tags
+
+
+# Ogg Vorbis/Opus: https://xiph.org/vorbis/doc/Vorbis_I_spec.html, https://www.rfc-editor.org/rfc/rfc7845
+
+
+VORBIS_COMMENTS = {
+    "TITLE": "title",
+    "ARTIST": "artist",
+    "ALBUM": "album",
+    "ALBUMARTIST": "album_artist",
+    "GENRE": "genre",
+    "COMPOSER": "composer",
+    "DATE": "recording_date",
+}
+OGG_TAIL_SIZE = 64 * 1024  # the last page (and its granule position) is looked for in the last bytes of the file
+
+
+def ogg_packets(f: BinaryIO, max_packets: int):
+    # the first packets of the stream, reassembled from the pages' segments
+    packet = b""
+    packets = 0
+    while packets < max_packets:
+        header = f.read(27)
+        if len(header) < 27 or header[:4] != b"OggS":
+            return
+
+        segments_count = header[26]
+        segments = f.read(segments_count)
+        for segment_size in segments:
+            packet += f.read(segment_size)
+            if segment_size < 255:
+                yield packet
+                packet = b""
+                packets += 1
+                if packets >= max_packets:
+                    return
+
+
+def ogg_last_granule(f: BinaryIO, file_size: int) -> Optional[int]:
+    f.seek(max(0, file_size - OGG_TAIL_SIZE))
+    tail = f.read()
+    offset = tail.rfind(b"OggS")
+    if offset == -1 or offset + 14 > len(tail):
+        return
+
+    return struct.unpack("<q", tail[offset + 6:offset + 14])[0]
+
+
+def parse_flac_picture(data: bytes) -> Optional[bytes]:
+    # METADATA_BLOCK_PICTURE: https://xiph.org/flac/format.html#metadata_block_picture
+    try:
+        offset = 4
+        mime_length = struct.unpack(">I", data[offset:offset + 4])[0]
+        offset += 4 + mime_length
+        description_length = struct.unpack(">I", data[offset:offset + 4])[0]
+        offset += 4 + description_length + 16
+        data_length = struct.unpack(">I", data[offset:offset + 4])[0]
+        return data[offset + 4:offset + 4 + data_length]
+    except struct.error:
+        return
+
+
+def read_vorbis_comments(data: bytes, tags: Tags, images: bool):
+    vendor_length = struct.unpack("<I", data[:4])[0]
+    offset = 4 + vendor_length
+    comments_count = struct.unpack("<I", data[offset:offset + 4])[0]
+    offset += 4
+    for _ in range(comments_count):
+        comment_length = struct.unpack("<I", data[offset:offset + 4])[0]
+        comment = data[offset + 4:offset + 4 + comment_length].decode("utf-8", errors="replace")
+        offset += 4 + comment_length
+
+        key, _, value = comment.partition("=")
+        key = key.upper()
+        if key in VORBIS_COMMENTS and not tags[VORBIS_COMMENTS[key]]:
+            tags[VORBIS_COMMENTS[key]] = value
+        elif key == "METADATA_BLOCK_PICTURE" and images:
+            image = parse_flac_picture(base64.b64decode(value))
+            if image:
+                tags["images"].append(image)
+
+
+def read_ogg(f: BinaryIO, file_size: int, images=True) -> Optional[Tags]:
+    packets = list(ogg_packets(f, 2))
+    if len(packets) < 2:
+        return
+
+    tags = empty_tags()
+    identification, comments = packets
+    if identification.startswith(b"\x01vorbis") and comments.startswith(b"\x03vorbis"):
+        sample_rate = struct.unpack("<I", identification[12:16])[0]
+        pre_skip = 0
+        read_vorbis_comments(comments[7:], tags, images)
+    elif identification.startswith(b"OpusHead") and comments.startswith(b"OpusTags"):
+        # opus granule positions are always in 48 kHz samples
+        sample_rate = 48000
+        pre_skip = struct.unpack("<H", identification[10:12])[0]
+        read_vorbis_comments(comments[8:], tags, images)
+    else:
+        return
+
+    granule = ogg_last_granule(f, file_size)
+    if granule and granule > 0 and sample_rate:
+        tags["time_secs"] = max(0, granule - pre_skip) / sample_rate
+
+    return tags
+
+
+# ASF (wma): https://docs.microsoft.com/en-us/windows/win32/wmformat/overview-of-the-asf-format
+
+
+def asf_guid(value: str) -> bytes:
+    return uuid.UUID(value).bytes_le
+
+
+ASF_HEADER = asf_guid("75B22630-668E-11CF-A6D9-00AA0062CE6C")
+ASF_FILE_PROPERTIES = asf_guid("8CABDCA1-A947-11CF-8EE4-00C00C205365")
+ASF_CONTENT_DESCRIPTION = asf_guid("75B22633-668E-11CF-A6D9-00AA0062CE6C")
+ASF_EXTENDED_CONTENT_DESCRIPTION = asf_guid("D2D0A440-E307-11D2-97F0-00A0C95EA850")
+ASF_ATTRIBUTES = {
+    "WM/AlbumTitle": "album",
+    "WM/AlbumArtist": "album_artist",
+    "WM/Genre": "genre",
+    "WM/Composer": "composer",
+    "WM/Year": "recording_date",
+}
+
+
+def utf16(data: bytes) -> str:
+    return data.decode("utf-16-le", errors="replace").rstrip("\0")
+
+
+def parse_asf_picture(data: bytes) -> Optional[bytes]:
+    # WM/Picture: picture type (1 byte), data length (4), mime type and description (null terminated utf-16), data
+    data_length = struct.unpack("<I", data[1:5])[0]
+    offset = 5
+    for _ in range(2):
+        while offset + 2 <= len(data) and data[offset:offset + 2] != b"\0\0":
+            offset += 2
+        offset += 2
+
+    return data[offset:offset + data_length] or None
+
+
+def read_asf(f: BinaryIO, file_size: int, images=True) -> Optional[Tags]:
+    header = f.read(30)
+    if len(header) < 30 or header[:16] != ASF_HEADER:
+        return
+
+    header_size, objects_count = struct.unpack("<QI", header[16:28])
+    data = f.read(header_size - 30)
+
+    tags = empty_tags()
+    offset = 0
+    for _ in range(objects_count):
+        if offset + 24 > len(data):
+            break
+
+        guid = data[offset:offset + 16]
+        object_size = struct.unpack("<Q", data[offset + 16:offset + 24])[0]
+        payload = data[offset + 24:offset + object_size]
+
+        if guid == ASF_FILE_PROPERTIES:
+            # 100-nanosecond units, the preroll (milliseconds) is included
+            play_duration, _, preroll = struct.unpack("<QQQ", payload[40:64])
+            tags["time_secs"] = max(0.0, play_duration / 10 ** 7 - preroll / 1000)
+        elif guid == ASF_CONTENT_DESCRIPTION:
+            lengths = struct.unpack("<5H", payload[:10])
+            values = []
+            value_offset = 10
+            for length in lengths:
+                values.append(utf16(payload[value_offset:value_offset + length]))
+                value_offset += length
+            tags["title"], tags["artist"] = values[0] or None, values[1] or None
+        elif guid == ASF_EXTENDED_CONTENT_DESCRIPTION:
+            attributes_count = struct.unpack("<H", payload[:2])[0]
+            attribute_offset = 2
+            for _ in range(attributes_count):
+                name_length = struct.unpack("<H", payload[attribute_offset:attribute_offset + 2])[0]
+                name = utf16(payload[attribute_offset + 2:attribute_offset + 2 + name_length])
+                attribute_offset += 2 + name_length
+                value_type, value_length = struct.unpack("<HH", payload[attribute_offset:attribute_offset + 4])
+                value = payload[attribute_offset + 4:attribute_offset + 4 + value_length]
+                attribute_offset += 4 + value_length
+
+                if name in ASF_ATTRIBUTES and value_type == 0:
+                    tags[ASF_ATTRIBUTES[name]] = utf16(value) or None
+                elif name == "WM/Picture" and value_type == 1 and images:
+                    image = parse_asf_picture(value)
+                    if image:
+                        tags["images"].append(image)
+
+        offset += object_size
+
+    return tags
+
+
+READERS: Dict[str, Callable[..., Optional[Tags]]] = {
+    ".m4a": read_mp4,
+    ".mp4": read_mp4,
+    ".wav": read_wav,
+    ".ogg": read_ogg,
+    ".oga": read_ogg,
+    ".opus": read_ogg,
+    ".wma": read_asf,
+}
+
+
+def reader_for(file_path: Union[Path, str]) -> Optional[Callable[..., Optional[Tags]]]:
+    return READERS.get(os.path.splitext(str(file_path))[1].lower())
+
+
+def read(file_path: Union[Path, str], images=True) -> Optional[Tags]:
+    # None: unsupported extension or the file doesn't look like the format its extension says.
+    # Truncated or malformed headers raise struct.error/ValueError/IndexError
+    reader = reader_for(file_path)
+    if not reader:
+        return
+
+    with open(file_path, "rb") as f:
+        return reader(f, os.fstat(f.fileno()).st_size, images=images)
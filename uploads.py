@@ -0,0 +1,163 @@
+import os
+import math
+import time
+import asyncio
+from pathlib import Path
+from typing import Optional, List, Callable
+
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from loguru import logger
+
+import utilities as utilities
+import metrics as metrics
+
+
+class FileName:
+    UPLOAD_PROGRESS = "data/upload-progress.json"
+
+
+PART_SIZE = 512 * 1024
+BIG_FILE_SIZE = 10 * 1024 * 1024  # files bigger than this are uploaded with upload.saveBigFilePart
+FILE_SIZE_LIMIT_MIB = 2000  # bots can't send bigger files
+
+
+class StorageUploadProgress(utilities.JournaledStorage):
+    # file path -> bot that is uploading the file, random file_id used for its parts, size and mtime of the file and how
+    # many parts (counted from the first one) Telegram already acknowledged
+    indent = None
+
+    def __init__(self, file_path=FileName.UPLOAD_PROGRESS, **kwargs):
+        super().__init__(file_path, init_object={}, autosave=True, **kwargs)
+
+    def _apply(self, record: List):
+        key, value = record
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self._data[key] = value
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._data.get(key)
+
+    def set(self, key: str, value: dict):
+        self._data[key] = value
+        self._log([key, value])
+
+    def remove(self, key: str):
+        if key in self._data:
+            self._data.pop(key)
+            self._log([key, None])
+
+
+class ResumableUploader:
+    # replacement for Client.save_file() for big files: acknowledged parts are recorded in StorageUploadProgress, so an
+    # upload interrupted by a crash or a lost connection continues from the last acknowledged part on the next run.
+    # Parts that fail are retried with a backoff instead of failing the whole upload. Telegram only keeps uploaded parts
+    # for a while: uploads older than `max_age` seconds start over
+    def __init__(self, client: Client, storage: StorageUploadProgress, parallel_parts=4, max_age=12 * 3600, max_retries=10, save_every=8):
+        self._client = client
+        self._storage = storage
+        self._parallel_parts = parallel_parts
+        self._max_age = max_age
+        self._max_retries = max_retries
+        self._save_every = save_every  # parts
+
+    def _load_state(self, file_path: Path) -> dict:
+        stat = os.stat(file_path)
+        state = self._storage.get(str(file_path))
+
+        if (
+                not state
+                or state.get("account", self._client.name) != self._client.name  # parts belong to the bot that uploaded them
+                or state["size"] != stat.st_size
+                or state["mtime_ns"] != stat.st_mtime_ns
+                or time.time() - state["started"] > self._max_age
+        ):
+            state = dict(
+                account=self._client.name,
+                file_id=self._client.rnd_id(),
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                started=time.time(),
+                parts_acked=0
+            )
+            self._storage.set(str(file_path), state)
+        elif state["parts_acked"]:
+            logger.info(f"resuming the upload of {file_path.name} from part {state['parts_acked']}")
+
+        return state
+
+    async def _save_part(self, session: Session, file_id: int, part: int, total_parts: int, chunk: bytes):
+        for attempt in range(self._max_retries):
+            try:
+                rpc = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=chunk)
+                if await session.invoke(rpc):
+                    return
+            except FloodWait as e:
+                metrics.inc("flood_waits")
+                metrics.inc("flood_wait_seconds", e.value)
+                await asyncio.sleep(e.value)
+                continue
+            except Exception as e:
+                metrics.inc("retries")
+                logger.warning(f"upload of part {part} failed: {e}")
+
+            await asyncio.sleep(min(60, 2 ** attempt))
+
+        raise ValueError(f"part {part} couldn't be uploaded after {self._max_retries} attempts")
+
+    async def save_file(self, file_path: Path, progress: Optional[Callable] = None, progress_args: tuple = ()) -> raw.types.InputFileBig:
+        state = self._load_state(file_path)
+        total_parts = math.ceil(state["size"] / PART_SIZE)
+        parts = iter(range(state["parts_acked"], total_parts))  # shared by the part workers
+        acked_parts = set()
+        saved_parts_acked = state["parts_acked"]
+        loop = asyncio.get_running_loop()
+
+        async def part_worker():
+            nonlocal saved_parts_acked
+
+            with open(file_path, "rb") as f:
+                for part in parts:
+                    f.seek(part * PART_SIZE)
+                    chunk = await loop.run_in_executor(None, f.read, PART_SIZE)
+                    await self._save_part(session, state["file_id"], part, total_parts, chunk)
+
+                    # only the first parts without gaps can be skipped on resume
+                    acked_parts.add(part)
+                    parts_acked = state["parts_acked"]
+                    while parts_acked in acked_parts:
+                        acked_parts.remove(parts_acked)
+                        parts_acked += 1
+
+                    state["parts_acked"] = parts_acked
+                    if parts_acked - saved_parts_acked >= self._save_every or parts_acked == total_parts:
+                        self._storage.set(str(file_path), state)
+                        saved_parts_acked = parts_acked
+
+                    if progress:
+                        await progress(min(parts_acked * PART_SIZE, state["size"]), state["size"], *progress_args)
+
+        session = Session(
+            self._client, await self._client.storage.dc_id(), await self._client.storage.auth_key(),
+            await self._client.storage.test_mode(), is_media=True
+        )
+        await session.start()
+
+        workers = [asyncio.create_task(part_worker()) for _ in range(self._parallel_parts)]
+        try:
+            await asyncio.gather(*workers)
+        except Exception:
+            for worker in workers:
+                worker.cancel()
+            raise
+        finally:
+            await session.stop()
+
+        return raw.types.InputFileBig(id=state["file_id"], parts=total_parts, name=file_path.name)
+
+    def done(self, file_path: Path):
+        # call once the message has been posted: the parts are not needed anymore
+        self._storage.remove(str(file_path))
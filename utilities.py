@@ -1,17 +1,28 @@
 import sys
 import os
 import json
+import time
+import hashlib
+import asyncio
+import contextlib
+import multiprocessing
 from pathlib import Path
-from typing import Union, Optional, List, Tuple
+from typing import Union, Optional, List, Dict, Tuple, Iterator, Callable, Sequence
 
 from loguru import logger
 
+import metrics as metrics
+
 
 def get_logger(file_name):
     file_name = os.path.basename(file_name).replace('.py', '')
+    if multiprocessing.current_process().name != "MainProcess":
+        # a process pool's worker importing the main script again: it doesn't log, no new log file
+        return logger
 
     logger.remove()
-    logger.add(f"logs/{file_name}" + "_{time:YYYYMMDD_HHmmss}.log")
+    # enqueue: lines are written to the file by a background thread, so logging never blocks the event loop on disk
+    logger.add(f"logs/{file_name}" + "_{time:YYYYMMDD_HHmmss}.log", enqueue=True)
     logger.add(
         sys.stdout,
         level="INFO",
@@ -36,55 +47,205 @@ def human_readable_size(size, precision=2):
     return string.replace(".00", "")  # always trim final ".00"
 
 
+def hash_file(file_path: Union[Path, str], chunk_size=1024 * 1024) -> str:
+    # reads the file in chunks, so memory usage doesn't depend on the file size
+    file_hash = hashlib.blake2b(digest_size=32)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def fsync_dir(file_path):
+    # makes a rename durable. Directories can't be opened on windows
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+
+    fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FsyncPolicy:
+    ALWAYS = "always"  # every journal record is fsync'd before add() returns
+    INTERVAL = "interval"  # at most one fsync every `fsync_interval` seconds
+    NEVER = "never"  # leave it to the OS
+
+
 class Storage:
-    def __init__(self, file_path, init_object, autosave=False):
+    indent = 4
+
+    def __init__(self, file_path, init_object, autosave=False, read_only=False):
+        # read_only: the file is only looked at (eg. while main.py is running), it's never written
         self._file_path = os.path.normpath(file_path)
         self._autosave = autosave
+        self._read_only = read_only
 
         try:
             with open(self._file_path, 'r') as f:
                 self._data = json.load(f)
         except FileNotFoundError:
             self._data = init_object
+            if not read_only:
+                self.dump()
+
+    def dump(self, fsync=True):
+        # write to a temporary file first, so a crash while dumping never leaves a truncated file behind
+        tmp_file_path = self._file_path + ".tmp"
+        with metrics.span("storage_dump", file=os.path.basename(self._file_path)):
+            with open(tmp_file_path, 'w+') as f:
+                json.dump(self._data, f, indent=self.indent)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            os.replace(tmp_file_path, self._file_path)
+            if fsync:
+                fsync_dir(self._file_path)
+
+
+class JournaledStorage(Storage):
+    # changes are appended to a "<file>.journal" file (one json record per line) instead of re-dumping the whole file
+    # every time. The journal is merged back into the json file (and truncated) once it has `compact_every` records and
+    # `compact_fraction` times the entries of the json file: the cost of the dumps stays proportional to the records
+    # written, no matter how large the file grows. On startup the json file is loaded and the journal is replayed on
+    # top of it. A read-only storage replays the journal but never appends to it, nor truncates it: another process
+    # may be writing it
+    def __init__(self, file_path, init_object, autosave=False, compact_every=1000, compact_fraction=0.5, fsync=FsyncPolicy.INTERVAL, fsync_interval=5.0, read_only=False):
+        self._journal = None
+        self._journal_path = os.path.normpath(file_path) + ".journal"
+        self._journal_records = 0
+        self._compact_every = compact_every
+        self._compact_fraction = compact_fraction
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._last_fsync = 0.0
+
+        super().__init__(file_path, init_object, autosave=autosave, read_only=read_only)
+        self._snapshot_size = len(self._data)
+
+        self._build_index()
+        complete = self._replay_journal()
+        if read_only:
+            # a partial last line is the record being appended right now
+            return
+
+        self._journal = open(self._journal_path, 'a')
+
+        if not complete:
+            # new records can't be appended after a partial line
+            self.dump()
+
+    def _build_index(self):
+        pass
+
+    def _apply(self, record):
+        raise NotImplementedError
+
+    def _replay_journal(self):
+        try:
+            with open(self._journal_path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the process died while appending the last record
+                        return False
+
+                    self._apply(record)
+                    self._journal_records += 1
+        except FileNotFoundError:
+            pass
+
+        return True
+
+    def _log(self, record):
+        with metrics.span("storage_journal", file=os.path.basename(self._file_path)):
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+            self._journal_records += 1
+
+            now = time.monotonic()
+            if self._fsync == FsyncPolicy.ALWAYS or (self._fsync == FsyncPolicy.INTERVAL and now - self._last_fsync >= self._fsync_interval):
+                os.fsync(self._journal.fileno())
+                self._last_fsync = now
+
+        if self._journal_records >= max(self._compact_every, self._compact_fraction * self._snapshot_size):
             self.dump()
 
     def dump(self):
-        with open(self._file_path, 'w+') as f:
-            json.dump(self._data, f, indent=4)
+        super().dump()
+        self._snapshot_size = len(self._data)
+
+        # everything in the journal is now in the json file
+        if self._journal:
+            self._journal.close()
+            self._journal = open(self._journal_path, 'w')
+            self._journal_records = 0
 
 
-class StorageList(Storage):
+class StorageList(JournaledStorage):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._path_split = "..."
 
+    def _build_index(self):
+        # the list keeps the insertion order in the json file, the set makes lookups O(1)
+        self._index = set(self._data)
+
+    def _apply(self, item: str):
+        if item not in self._index:
+            self._index.add(item)
+            self._data.append(item)
+
     def convert_path(self, p: Path):
         return self._path_split.join(p.parts)
 
     def add(self, p: Path, save=False, skip_duplicates=True):
         item = self.convert_path(p)
 
-        if skip_duplicates and item in self._data:
+        if skip_duplicates and item in self._index:
             return False
 
+        self._index.add(item)
         self._data.append(item)
 
         if save or self._autosave:
-            self.dump()
+            self._log(item)
 
         return True
 
     def exists(self, p: Path):
         item = self.convert_path(p)
 
-        return item in self._data
+        return item in self._index
 
 
-class StoragMessages(Storage):
+class StoragMessages(JournaledStorage):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, init_object={}, **kwargs)
         self._path_split = "..."
 
+    def _build_index(self):
+        # the highest message id is the last message posted: script_reconcile.py adds older messages, and add()
+        # overrides existing ones, so the insertion order can't be trusted
+        self._last_id = max(map(int, self._data), default=None)
+
+    def _apply(self, record: List):
+        message_id, value = record
+        self._data[message_id] = value
+        self._update_last_id(message_id)
+
+    def _update_last_id(self, message_id: str):
+        if self._last_id is None or int(message_id) > self._last_id:
+            self._last_id = int(message_id)
+
     def convert_path(self, p: Path):
         return self._path_split.join(p.parts)
 
@@ -106,9 +267,11 @@ class StoragMessages(Storage):
             text=text,
             origin_audio_path=origin_audio_path
         )
+        self._update_last_id(message_id)
 
         if save or self._autosave:
-            self.dump()
+            # one small record per message, no matter how many messages are already stored
+            self._log([message_id, self._data[message_id]])
 
         return True
 
@@ -117,3 +280,281 @@ class StoragMessages(Storage):
 
         return message_id in self._data
 
+    def audio_message_ids(self) -> Dict[Tuple[str, ...], int]:
+        # path (parts) of every posted track -> its message id
+        return {tuple(value["origin_audio_path"]): int(message_id) for message_id, value in self._data.items() if value["origin_audio_path"]}
+
+    def last(self) -> Optional[dict]:
+        # the last message posted
+        return self._data[str(self._last_id)] if self._last_id is not None else None
+
+
+def walk_key(relative_parts: Sequence[str]):
+    # walk_files() yields a directory's files before its sub-directories, both sorted by name: this key sorts paths
+    # (relative to the walked directory, last part is the file name) in the same order they are yielded
+    return [(1, part) for part in relative_parts[:-1]] + [(0, relative_parts[-1])]
+
+
+def walk_files(
+        root: Union[Path, str],
+        allowed_extensions: Tuple[str, ...],
+        start_after: Optional[Sequence[str]] = None,
+        on_ignored: Optional[Callable[[Path], None]] = None
+) -> Iterator[Path]:
+    # lazy and sorted replacement for Path.rglob(): directories are read with os.scandir() only when the walk
+    # reaches them, and the dirent type is used instead of stat()'ing every entry.
+    # `start_after` is the path (relative to `root`, as returned by relative_parts()) of the last file
+    # handled by a previous run: everything up to it is skipped without reading the directories that
+    # come before it
+    cursor_key = walk_key(start_after) if start_after else None
+
+    def walk(dir_path: str, dir_key: List):
+        nonlocal cursor_key
+
+        files, dirs = [], []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+
+        for name in sorted(files):
+            if cursor_key:
+                if dir_key + [(0, name)] <= cursor_key:
+                    continue
+
+                # past the cursor: no more comparisons needed
+                cursor_key = None
+
+            file_path = Path(dir_path, name)
+            if not name.lower().endswith(allowed_extensions):
+                if on_ignored:
+                    on_ignored(file_path)
+                continue
+
+            yield file_path
+
+        for name in sorted(dirs):
+            sub_dir_key = dir_key + [(1, name)]
+            if cursor_key and sub_dir_key < cursor_key[:len(sub_dir_key)]:
+                # the whole directory comes before the cursor
+                continue
+
+            yield from walk(os.path.join(dir_path, name), sub_dir_key)
+
+    yield from walk(os.fspath(root), [])
+
+
+def relative_parts(file_path: Path, root: Union[Path, str]) -> List[str]:
+    return list(file_path.relative_to(root).parts)
+
+
+class StorageUploadedFiles(JournaledStorage):
+    # content hash (see hash_file()) -> file_id and id of the first message the content was posted with, and the name
+    # of the bot that posted it: file_ids can't be used by other bots
+    indent = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, init_object={}, **kwargs)
+
+    def _apply(self, record: List):
+        content_hash, value = record
+        self._data[content_hash] = value
+
+    def add(self, content_hash: str, message, account: Optional[str] = None, save=False):
+        media = message.audio or message.document
+        if not media:
+            return False
+
+        self._data[content_hash] = dict(
+            file_id=media.file_id,
+            message_id=message.id,
+            account=account
+        )
+
+        if save or self._autosave:
+            self._log([content_hash, self._data[content_hash]])
+
+        return True
+
+    def get(self, content_hash: str, account: Optional[str] = None) -> Optional[dict]:
+        value = self._data.get(content_hash)
+        if value and account and value.get("account", account) != account:
+            # posted by another bot
+            return
+
+        return value
+
+
+class StorageWalkCursor(Storage):
+    # last file handled for each walked directory, see walk_files(). Written with the journals' fsync policy: with
+    # "interval", at most once every `fsync_interval` seconds, flush() writes the latest one
+    def __init__(self, file_path, root, read_only=False, fsync=FsyncPolicy.ALWAYS, fsync_interval=5.0):
+        super().__init__(file_path, init_object={}, read_only=read_only)
+        self._root = os.path.normpath(root)
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._last_dump = 0.0
+        self._dirty = False
+
+    def get(self) -> Optional[List[str]]:
+        return self._data.get(self._root)
+
+    def set(self, parts: List[str]):
+        self._data[self._root] = parts
+        self._dirty = True
+        if self._fsync == FsyncPolicy.INTERVAL and time.monotonic() - self._last_dump < self._fsync_interval:
+            # a cursor a few files behind only makes the next walk go through them again, they are already processed
+            return
+
+        self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+
+        self.dump(fsync=self._fsync != FsyncPolicy.NEVER)
+        self._dirty = False
+        self._last_dump = time.monotonic()
+
+
+class StorageRateLimits(Storage):
+    # api method -> learned budget (calls per second), see ratelimit.Scheduler
+    def __init__(self, file_path, read_only=False):
+        super().__init__(file_path, init_object={}, read_only=read_only)
+
+    def get(self, method: str) -> Optional[float]:
+        return self._data.get(method)
+
+    def update(self, rates: dict):
+        self._data.update(rates)
+        self.dump()
+
+
+class StorageDeferredFiles(Storage):
+    # files skipped by the run (eg. too big to be uploaded by a bot): relative path -> reason
+    def __init__(self, file_path, root):
+        super().__init__(file_path, init_object={})
+        self._root = root
+
+    def add(self, file_path: Path, reason: str):
+        self._data[os.path.relpath(file_path, self._root)] = reason
+        self.dump()
+
+    def remove(self, file_path: Path):
+        if self._data.pop(os.path.relpath(file_path, self._root), None) is not None:
+            self.dump()
+
+    def prune(self, processed: StorageList):
+        # drop the files processed since (eg. sent manually and added by script_reconcile.py) or gone
+        pruned = False
+        for relative_path in list(self._data):
+            file_path = Path(self._root, relative_path)
+            if processed.exists(file_path) or not file_path.exists():
+                del self._data[relative_path]
+                pruned = True
+
+        if pruned:
+            self.dump()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PostingOrder:
+    # lets concurrent upload workers post their messages in the same order the files were queued
+    def __init__(self):
+        self._next_seq = 0
+        self._condition = asyncio.Condition()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    @contextlib.asynccontextmanager
+    async def turn(self, seq: int):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._next_seq == seq)
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._next_seq = seq + 1
+                self._condition.notify_all()
+
+
+class UploadQueue:
+    # files waiting for an upload worker. They are not handed out in the walk order: large files are started as soon as
+    # they are queued, but at most `large_slots` of them at the same time, so the other workers keep uploading the small
+    # ones in the meantime. With no `large_slots`, jobs are handed out in the walk order. Jobs need a `seq` and a `size`.
+    # At most `size` jobs can be queued and not yet posted
+    def __init__(self, size: int, large_file_size: int, large_slots: int):
+        self._size = size
+        self._large_file_size = large_file_size
+        self._large_slots = large_slots
+        self._pending = []  # sorted by seq
+        self._not_posted = 0
+        self._large_in_flight = 0
+        self._closed = False
+        self._condition = asyncio.Condition()
+
+    def is_large(self, job) -> bool:
+        return job.size >= self._large_file_size
+
+    async def put(self, job) -> bool:
+        # False: the queue has been closed, the job is dropped
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._not_posted < self._size or self._closed)
+            if self._closed:
+                return False
+
+            self._pending.append(job)
+            self._not_posted += 1
+            self._condition.notify_all()
+            return True
+
+    async def close(self):
+        # no more jobs: get() returns None once the pending ones are gone
+        async with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _pick(self):
+        if not self._large_slots:
+            return self._pending[0]
+
+        large = next((job for job in self._pending if self.is_large(job)), None)
+        small = next((job for job in self._pending if not self.is_large(job)), None)
+        if large and (self._large_in_flight < self._large_slots or not small):
+            return large
+
+        return small
+
+    async def get(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._pending or self._closed)
+            if not self._pending:
+                return
+
+            job = self._pick()
+            self._pending.remove(job)
+            if self.is_large(job):
+                self._large_in_flight += 1
+
+            return job
+
+    def uploaded(self, job):
+        if self.is_large(job):
+            self._large_in_flight -= 1
+
+    async def posted(self):
+        async with self._condition:
+            self._not_posted -= 1
+            self._condition.notify_all()
+
+    def drain(self) -> list:
+        # jobs that were never started
+        pending, self._pending = self._pending, []
+        return pending
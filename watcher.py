@@ -0,0 +1,237 @@
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import struct
+import asyncio
+from pathlib import Path
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+class Backend:
+    AUTO = "auto"
+    INOTIFY = "inotify"
+    POLLING = "polling"
+
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    # one inotify watch per directory. Directories created (or moved in) later are watched as soon as they appear, and
+    # the files already in them are reported, since they might have been written before the watch was added
+    def __init__(self, root: str, on_change: Callable[[Path], None]):
+        self._root = root
+        self._on_change = on_change
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._dirs: Dict[int, str] = {}  # watch descriptor -> directory path
+
+    def _add_dir(self, dir_path: str, report_files: bool):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            # ENOSPC: fs.inotify.max_user_watches reached
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {dir_path}")
+
+        self._dirs[wd] = dir_path
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    self._add_dir(entry.path, report_files)
+                elif report_files:
+                    self._on_change(Path(dir_path, entry.name))
+
+    def start(self):
+        try:
+            self._add_dir(self._root, report_files=False)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+        asyncio.get_running_loop().add_reader(self._fd, self._read)
+        logger.info(f"watching {len(self._dirs)} directories with inotify")
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # events have been lost: everything is reported again, the files already uploaded are skipped anyway
+                logger.warning("inotify queue overflow, rescanning")
+                self._add_dir(self._root, report_files=True)
+                continue
+
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+
+            dir_path = self._dirs.get(wd)
+            if not dir_path or not name:
+                continue
+
+            path = os.path.join(dir_path, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_dir(path, report_files=True)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logger.warning(f"unable to watch {path}: {e}")
+                continue
+
+            self._on_change(Path(dir_path, name))
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self._fd)
+        os.close(self._fd)
+
+
+def snapshot(root: str) -> Dict[str, Tuple[int, int]]:
+    # file path -> (size, mtime)
+    files = {}
+    dirs = [root]
+    while dirs:
+        dir_path = dirs.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        dirs.append(entry.path)
+                    else:
+                        stat = entry.stat()
+                        files[os.path.join(dir_path, entry.name)] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+
+    return files
+
+
+class PollingWatcher:
+    # fallback for platforms (or file systems, eg. network mounts) without inotify: the tree is stat()'ed every
+    # `interval` seconds and compared with the previous scan
+    def __init__(self, root: str, on_change: Callable[[Path], None], interval: float):
+        self._root = root
+        self._on_change = on_change
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(snapshot(self._root)))
+        logger.info(f"watching {self._root} by polling it every {self._interval} seconds")
+
+    async def _run(self, previous: Dict[str, Tuple[int, int]]):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._interval)
+            current = await loop.run_in_executor(None, snapshot, self._root)
+            for path, stat in current.items():
+                if previous.get(path) != stat:
+                    self._on_change(Path(path))
+
+            previous = current
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+
+def create(root: str, on_change: Callable[[Path], None], backend=Backend.AUTO, poll_interval=60.0):
+    if backend != Backend.POLLING:
+        try:
+            watcher = InotifyWatcher(root, on_change)
+            watcher.start()
+            return watcher
+        except (OSError, AttributeError) as e:
+            # AttributeError: no inotify_init1 in the c library (not linux)
+            if backend == Backend.INOTIFY:
+                raise
+
+            code = errno.errorcode.get(getattr(e, "errno", None), "")
+            logger.warning(f"inotify not available ({code or e}), falling back to polling")
+
+    watcher = PollingWatcher(root, on_change, poll_interval)
+    watcher.start()
+    return watcher
+
+
+class SettledFiles:
+    # files reported by a watcher are only handed out once their size and mtime haven't changed for `settle_seconds`,
+    # so files still being copied are not uploaded half-written. A directory is handed out only when all its pending
+    # files are settled, so an album copied in one go is uploaded in one go
+    def __init__(self, settle_seconds: float):
+        self._settle_seconds = settle_seconds
+        self._pending: Dict[Path, Tuple[Optional[Tuple[int, int]], float]] = {}  # path -> (size, mtime), last change
+
+    @staticmethod
+    def _stat(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def touch(self, path: Path):
+        self._pending[path] = (self._stat(path), time.monotonic())
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pop_settled(self) -> List[List[Path]]:
+        now = time.monotonic()
+        by_dir: Dict[Path, List[Path]] = defaultdict(list)
+        unsettled_dirs = set()
+        for path, (stat, last_change) in list(self._pending.items()):
+            current_stat = self._stat(path)
+            if current_stat is None:
+                # deleted (or renamed: the new name is reported on its own)
+                del self._pending[path]
+                continue
+
+            if current_stat != stat:
+                self._pending[path] = (current_stat, now)
+                unsettled_dirs.add(path.parent)
+            elif now - last_change < self._settle_seconds:
+                unsettled_dirs.add(path.parent)
+            else:
+                by_dir[path.parent].append(path)
+
+        settled = []
+        for dir_path, paths in by_dir.items():
+            if dir_path in unsettled_dirs:
+                continue
+
+            for path in paths:
+                del self._pending[path]
+            settled.append(paths)
+
+        return settled